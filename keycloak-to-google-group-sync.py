@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+"""
+Continuously propagate membership of KeyCloak mailing list groups (by default,
+subgroups of /mail) to the corresponding Google groups.
+
+Each poll computes the desired membership of every group (members of the group
+itself, plus managers from its _admin subgroup) and compares it against the
+membership last pushed to Google, which is kept in a local SQLite state file.
+Only the differences are sent to Google, using batch requests.
+
+KeyCloak has no cheap way of telling what changed, so every poll pages
+through the membership of every group, i.e. it is a full roster scan of
+KeyCloak. A signature of each group's desired membership is recorded after
+the group has been fully synced, and groups with an unchanged signature are
+not diffed and cause no Google requests, but they are still read.
+
+The first time a group is seen its sync state is seeded from Google, which
+may have members that are not in KeyCloak (e.g. external subscribers). Members
+that this daemon has seen in KeyCloak are removed from Google when they leave
+the KeyCloak group (or change their mailing list address). Members known only
+from Google are left alone unless --delete is given.
+
+A group that fails to sync (e.g. because its Google group doesn't exist) is
+logged and retried on the next poll; it doesn't affect the other groups.
+"""
+
+import argparse
+import asyncio
+import colorlog
+import hashlib
+import logging
+import sqlite3
+import sys
+import time
+from google.oauth2 import service_account
+from googleapiclient import discovery
+
+from krs.token import get_rest_client
+from krs.groups import get_group_hierarchy, flatten_group_hierarchy, get_group_membership_by_id
+from krs.users import list_users, user_info
+
+handler = colorlog.StreamHandler()
+handler.setFormatter(colorlog.ColoredFormatter("%(log_color)s%(levelname)s:%(message)s"))
+logger = colorlog.getLogger("group-sync")
+logger.propagate = False
+logger.addHandler(handler)
+
+# https://developers.google.com/admin-sdk/directory/v1/guides/batch
+MAX_GOOGLE_BATCH_SIZE = 1000
+
+
+class SyncState:
+    """Membership of Google groups as of the last successful sync."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS groups ("
+            "  group_email TEXT PRIMARY KEY,"
+            "  signature TEXT)"  # of desired membership as of the last complete sync
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS members ("
+            "  group_email TEXT NOT NULL,"
+            "  member_email TEXT NOT NULL,"
+            "  role TEXT NOT NULL,"
+            "  delivery TEXT NOT NULL,"
+            "  managed INTEGER NOT NULL DEFAULT 0,"  # seen in KeyCloak, as opposed to only in Google
+            "  PRIMARY KEY (group_email, member_email))"
+        )
+        self.db.commit()
+
+    def group_signatures(self):
+        """Return {group_email: signature} of groups whose state has been seeded."""
+        return dict(self.db.execute("SELECT group_email, signature FROM groups"))
+
+    def add_group(self, group_email):
+        self.db.execute("INSERT OR IGNORE INTO groups (group_email) VALUES (?)", (group_email,))
+
+    def set_signature(self, group_email, signature):
+        self.db.execute("UPDATE groups SET signature = ? WHERE group_email = ?", (signature, group_email))
+
+    def get_members(self, group_email):
+        rows = self.db.execute(
+            "SELECT member_email, role, delivery FROM members WHERE group_email = ?", (group_email,)
+        )
+        return {email: (role, delivery) for email, role, delivery in rows}
+
+    def get_managed(self, group_email):
+        """Return addresses of members of `group_email` that came from KeyCloak."""
+        rows = self.db.execute(
+            "SELECT member_email FROM members WHERE group_email = ? AND managed", (group_email,)
+        )
+        return {row[0] for row in rows}
+
+    def set_member(self, group_email, member_email, role, delivery, managed):
+        self.db.execute(
+            "INSERT OR REPLACE INTO members (group_email, member_email, role, delivery, managed)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (group_email, member_email, role, delivery, managed),
+        )
+
+    def set_managed(self, group_email, member_emails):
+        self.db.executemany(
+            "UPDATE members SET managed = 1 WHERE group_email = ? AND member_email = ?",
+            ((group_email, m) for m in member_emails),
+        )
+
+    def del_member(self, group_email, member_email):
+        self.db.execute(
+            "DELETE FROM members WHERE group_email = ? AND member_email = ?", (group_email, member_email)
+        )
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+
+def user_list_address(user):
+    """Return the address to which mailing list messages for KeyCloak `user` should go."""
+    attrs = user.get("attributes", {})
+    if attrs.get("mailing_list_email"):
+        return attrs["mailing_list_email"].lower()
+    if attrs.get("canonical_email"):
+        return attrs["canonical_email"].lower()
+    return f"{user['username']}@icecube.wisc.edu"
+
+
+def membership_signature(desired, delete):
+    """Return a short digest of desired membership (and of whether extraneous
+    members are deleted, since that also determines what a sync does)."""
+    return hashlib.sha1(repr((delete, sorted(desired.items()))).encode()).hexdigest()
+
+
+def compute_delta(current, desired):
+    """Return (inserts, deletes, patches) that turn `current` into `desired`.
+
+    Both arguments are dicts {member_email: (role, delivery)}. Members may have
+    picked a delivery mode themselves (e.g. digest), so only whether a member
+    gets mail at all (delivery NONE or not) is enforced.
+    """
+    inserts = {m: rd for m, rd in desired.items() if m not in current}
+    deletes = [m for m in current if m not in desired]
+    patches = {}
+    for m, (role, delivery) in desired.items():
+        if m not in current:
+            continue
+        cur_role, cur_delivery = current[m]
+        if (cur_delivery == "NONE") == (delivery == "NONE"):
+            delivery = cur_delivery
+        if (cur_role, cur_delivery) != (role, delivery):
+            patches[m] = (role, delivery)
+    return inserts, deletes, patches
+
+
+def get_google_group_members(svc, group_email):
+    """Return {member_email: (role, delivery)} of a Google group (excluding owners)."""
+    ret = {}
+    req = svc.members().list(groupKey=group_email, maxResults=200)
+    while req is not None:
+        resp = req.execute()
+        for m in resp.get("members", []):
+            if m["role"] != "OWNER" and "email" in m:
+                ret[m["email"].lower()] = (m["role"], m.get("delivery_settings", "ALL_MAIL"))
+        req = svc.members().list_next(req, resp)
+    return ret
+
+
+def push_delta(svc, state, group_email, inserts, deletes, patches, batch_size):
+    """Send membership changes of one group to Google in batches and record
+    the successful ones in `state`.
+
+    Changes that fail are not recorded and so will be retried on the next poll.
+
+    Returns:
+        int: number of failed changes
+    """
+    members = svc.members()
+    ops = []
+    for email, (role, delivery) in inserts.items():
+        body = {"email": email, "role": role, "delivery_settings": delivery}
+        ops.append(
+            (
+                members.insert(groupKey=group_email, body=body),
+                lambda email=email, role=role, delivery=delivery: state.set_member(
+                    group_email, email, role, delivery, True
+                ),
+                409,  # entity already exists
+            )
+        )
+    for email in deletes:
+        ops.append(
+            (
+                members.delete(groupKey=group_email, memberKey=email),
+                lambda email=email: state.del_member(group_email, email),
+                404,  # entity does not exist
+            )
+        )
+    for email, (role, delivery) in patches.items():
+        body = {"role": role, "delivery_settings": delivery}
+        ops.append(
+            (
+                members.patch(groupKey=group_email, memberKey=email, body=body),
+                lambda email=email, role=role, delivery=delivery: state.set_member(
+                    group_email, email, role, delivery, True
+                ),
+                None,
+            )
+        )
+
+    failures = 0
+
+    def callback(request_id, response, exception):
+        nonlocal failures
+        _, on_success, benign_status = ops[int(request_id)]
+        if exception is not None and getattr(exception, "status_code", None) != benign_status:
+            logger.error(f"{group_email}: request {request_id} failed: {exception}")
+            failures += 1
+        else:
+            on_success()
+
+    for start in range(0, len(ops), batch_size):
+        batch = svc.new_batch_http_request(callback=callback)
+        for i in range(start, min(start + batch_size, len(ops))):
+            batch.add(ops[i][0], request_id=str(i))
+        batch.execute()
+    state.commit()
+    return failures
+
+
+async def get_desired_membership(group_id, admin_group_id, addr_from_username, keycloak):
+    """Return {member_email: (role, delivery)} that a Google group should have, based on KeyCloak."""
+
+    async def _addresses(gid):
+        ret = []
+        for username in await get_group_membership_by_id(gid, rest_client=keycloak):
+            if username not in addr_from_username:
+                user = await user_info(username, rest_client=keycloak)
+                addr_from_username[username] = user_list_address(user)
+            ret.append(addr_from_username[username])
+        return ret
+
+    members = set(await _addresses(group_id))
+    desired = {addr: ("MEMBER", "ALL_MAIL") for addr in members}
+    if admin_group_id:
+        for addr in await _addresses(admin_group_id):
+            # Admins who aren't also members manage the group without getting its mail
+            desired[addr] = ("MANAGER", "ALL_MAIL" if addr in members else "NONE")
+    return desired
+
+
+async def sync_once(
+    root_group, svc, state, addr_from_username, keycloak, batch_size, delete, max_deletes, dryrun
+):
+    groups = flatten_group_hierarchy(await get_group_hierarchy(rest_client=keycloak))
+    signatures = state.group_signatures()
+    deletes_left = max_deletes
+    for path, group in sorted(groups.items()):
+        if not path.startswith(root_group + "/") or path.endswith("/_admin"):
+            continue
+        group_email = group["attributes"].get("email")
+        if not group_email:
+            logger.debug(f"Skipping {path} (no email attribute)")
+            continue
+        group_email = group_email.lower()
+        admin_group = groups.get(path + "/_admin")
+
+        try:
+            desired = await get_desired_membership(
+                group["id"], admin_group["id"] if admin_group else None, addr_from_username, keycloak
+            )
+            signature = membership_signature(desired, delete)
+            if signatures.get(group_email) == signature:
+                continue
+
+            if group_email not in signatures:
+                logger.info(f"Seeding sync state of {group_email} from Google")
+                for email, (role, delivery) in get_google_group_members(svc, group_email).items():
+                    state.set_member(group_email, email, role, delivery, False)
+                state.add_group(group_email)
+                state.commit()
+            current = state.get_members(group_email)
+            managed = state.get_managed(group_email)
+
+            inserts, deletes, patches = compute_delta(current, desired)
+            # Members that were seeded from Google and turn out to be in KeyCloak
+            # are from now on removed when they leave the KeyCloak group.
+            claimed = [m for m in desired if m in current and m not in managed]
+            unmanaged = [m for m in deletes if m not in managed]
+            if unmanaged and not delete:
+                logger.info(
+                    f"{group_email}: keeping {len(unmanaged)} member(s) known only from Google (see --delete)"
+                )
+                deletes = [m for m in deletes if m in managed]
+            capped = False
+            if len(deletes) > deletes_left:
+                logger.warning(
+                    f"{group_email}: deleting only {deletes_left} of {len(deletes)} member(s) "
+                    f"(--max-deletes-per-pass reached)"
+                )
+                deletes = deletes[:deletes_left]
+                capped = True
+            deletes_left -= len(deletes)
+
+            if inserts or deletes or patches:
+                logger.info(
+                    f"{path} -> {group_email}: {len(inserts)} insert(s), "
+                    f"{len(deletes)} delete(s), {len(patches)} role/delivery change(s)"
+                )
+            for email, (role, delivery) in inserts.items():
+                logger.debug(f"{group_email}: insert {email} as {role} (delivery {delivery})")
+            for email in deletes:
+                logger.debug(f"{group_email}: delete {email}")
+            for email, (role, delivery) in patches.items():
+                logger.debug(f"{group_email}: change {email} to {role} (delivery {delivery})")
+            if dryrun:
+                continue
+            state.set_managed(group_email, claimed)
+            failures = push_delta(svc, state, group_email, inserts, deletes, patches, batch_size)
+            if failures:
+                logger.warning(f"{group_email}: {failures} change(s) failed; will retry on the next poll")
+            elif not capped:
+                state.set_signature(group_email, signature)
+                state.commit()
+        except Exception:
+            # Don't let one group (e.g. one without a Google group) hold up all the others
+            state.rollback()
+            logger.exception(f"Failed to sync {path} -> {group_email}; will retry on the next poll")
+
+
+async def sync_loop(args, svc, state, keycloak):
+    addr_from_username = {}
+    users_refreshed_at = 0
+    while True:
+        started_at = time.monotonic()
+        try:
+            if started_at - users_refreshed_at > args.user_refresh_interval:
+                logger.info("Refreshing mailing list addresses of all KeyCloak users")
+                all_users = await list_users(rest_client=keycloak)
+                addr_from_username = {u: user_list_address(info) for u, info in all_users.items()}
+                users_refreshed_at = started_at
+            await sync_once(
+                args.keycloak_root_group,
+                svc,
+                state,
+                addr_from_username,
+                keycloak,
+                args.batch_size,
+                args.delete,
+                args.max_deletes_per_pass,
+                args.dry_run,
+            )
+        except Exception:
+            if args.once:
+                raise
+            logger.exception("Sync pass failed")
+        if args.once:
+            break
+        elapsed = time.monotonic() - started_at
+        logger.debug(f"Sync pass took {elapsed:.1f} seconds")
+        await asyncio.sleep(max(0, args.poll_interval - elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Continuously synchronize membership of KeyCloak mailing list groups\n"
+        "to Google groups using Google API¹. Google group address is taken\n"
+        "from the KeyCloak group's 'email' attribute. Members of the _admin\n"
+        "subgroup become managers.",
+        epilog="Notes:\n"
+        "[1] The following APIs must be enabled: Admin SDK.\n"
+        "[2] The service account needs to be set up for domain-wide delegation.\n"
+        "[3] The delegate account needs to have a Google Workspace admin role.",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--keycloak-root-group",
+        metavar="PATH",
+        default="/mail",
+        help="synchronize subgroups of this KeyCloak group (default: /mail)",
+    )
+    parser.add_argument(
+        "--state-db",
+        metavar="PATH",
+        required=True,
+        help="SQLite file that tracks membership pushed to Google",
+    )
+    parser.add_argument(
+        "--sa-creds",
+        metavar="PATH",
+        required=True,
+        help="service account credentials JSON²",
+    )
+    parser.add_argument(
+        "--sa-delegate",
+        metavar="EMAIL",
+        required=True,
+        help="the principal whom the service account will impersonate³",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        metavar="SECONDS",
+        type=float,
+        default=300,
+        help="start a sync pass at most every SECONDS; every pass reads the membership\n"
+        "of all groups from KeyCloak (default: 300)",
+    )
+    parser.add_argument(
+        "--user-refresh-interval",
+        metavar="SECONDS",
+        type=float,
+        default=3600,
+        help="how often to re-read mailing list addresses of all KeyCloak users\n(default: 3600)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        metavar="NUM",
+        type=int,
+        default=50,
+        help=f"maximum number of requests in a Google API batch (default: 50, max: {MAX_GOOGLE_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="also remove members of Google groups who were never seen in KeyCloak\n"
+        "(e.g. external subscribers); members that were seen in KeyCloak\n"
+        "are always removed when they leave the KeyCloak group",
+    )
+    parser.add_argument(
+        "--max-deletes-per-pass",
+        metavar="NUM",
+        type=int,
+        default=100,
+        help="remove at most NUM members per sync pass (default: 100)",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="perform a single sync pass and exit",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="log changes that would be made without making them",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="info",
+        choices=("debug", "info", "warning", "error"),
+        help="logging level (default: info)",
+    )
+    args = parser.parse_args()
+
+    if not 0 < args.batch_size <= MAX_GOOGLE_BATCH_SIZE:
+        parser.error(f"--batch-size must be between 1 and {MAX_GOOGLE_BATCH_SIZE}")
+    if args.max_deletes_per_pass < 0:
+        parser.error("--max-deletes-per-pass must not be negative")
+
+    logger.setLevel(getattr(logging, args.log_level.upper()))
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format="%(levelname)s %(message)s",
+    )
+    if args.log_level == "info":
+        ClientCredentialsAuth = logging.getLogger("ClientCredentialsAuth")
+        ClientCredentialsAuth.setLevel(logging.WARNING)  # too noisy
+
+    scopes = ["https://www.googleapis.com/auth/admin.directory.group.member"]
+    creds = service_account.Credentials.from_service_account_file(
+        args.sa_creds, scopes=scopes, subject=args.sa_delegate
+    )
+    svc = discovery.build("admin", "directory_v1", credentials=creds, cache_discovery=False)
+    state = SyncState(args.state_db)
+    keycloak = get_rest_client()
+
+    try:
+        asyncio.run(sync_loop(args, svc, state, keycloak))
+    except KeyboardInterrupt:
+        logger.info("Interrupted")
+    finally:
+        state.close()
+        svc.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+Answer questions about membership across all mailman lists, e.g. which
+external addresses are on the most lists, or which lists have no members
+left after restricting them to a domain.
+
+Pickles created by `pickle-mailman-list.py` are combined into a sparse
+address-by-list matrix, stored in compressed sparse column form: for list j,
+the address ids of its entries are indices[indptr[j]:indptr[j+1]] and
+the corresponding role bits are roles[indptr[j]:indptr[j+1]]. Addresses
+are interned (lower-cased) into integer ids. The matrix is cached in a
+NumPy .npz file and rebuilt only when the set of pickles or their
+modification times change.
+"""
+
+import argparse
+import colorlog
+import logging
+import numpy as np
+import os
+import re
+import sys
+
+from utils import load_mailman_list
+
+handler = colorlog.StreamHandler()
+handler.setFormatter(colorlog.ColoredFormatter("%(log_color)s%(levelname)s:%(message)s"))
+logger = colorlog.getLogger("membership-matrix")
+logger.propagate = False
+logger.addHandler(handler)
+
+# Role bits. An address can have several roles in the same list.
+DIGEST = 1
+REGULAR = 2
+OWNER = 4
+NONMEMBER = 8  # accept_these_nonmembers
+SUBSCRIBER = DIGEST | REGULAR
+ROLE_NAMES = {DIGEST: "digest", REGULAR: "regular", OWNER: "owner", NONMEMBER: "nonmember"}
+
+
+class MembershipMatrix:
+    def __init__(self, lists, addresses, indptr, indices, roles, sources):
+        self.lists = lists  # list addresses, one per column
+        self.addresses = addresses  # member addresses, one per row
+        self.indptr = indptr
+        self.indices = indices
+        self.roles = roles
+        self.sources = sources  # (path, mtime) of pickles the matrix was built from
+
+        self.domains, self.domain_ids = np.unique(
+            np.array([a.rsplit("@", 1)[-1] for a in addresses], dtype=str), return_inverse=True
+        )
+        # list (column) id of every entry
+        self.entry_lists = np.repeat(np.arange(len(lists)), np.diff(indptr))
+
+    @classmethod
+    def build(cls, paths):
+        email_regex = re.compile(r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$")
+        address_ids = {}
+        lists, indptr, indices, roles = [], [0], [], []
+        for path in paths:
+            logger.debug(f"Loading {path}")
+            mmcfg = load_mailman_list(path)
+            entries = {}
+            for role, addrs in (
+                (DIGEST, mmcfg["digest_members"]),
+                (REGULAR, mmcfg["regular_members"]),
+                (OWNER, mmcfg["owner"]),
+                (NONMEMBER, [a for a in mmcfg["accept_these_nonmembers"] if email_regex.match(a)]),
+            ):
+                for addr in addrs:
+                    addr_id = address_ids.setdefault(addr.lower(), len(address_ids))
+                    entries[addr_id] = entries.get(addr_id, 0) | role
+            lists.append(mmcfg["email"].lower())
+            indices.extend(entries.keys())
+            roles.extend(entries.values())
+            indptr.append(len(indices))
+        return cls(
+            np.array(lists, dtype=str),
+            np.array(list(address_ids), dtype=str),
+            np.array(indptr, dtype=np.int64),
+            np.array(indices, dtype=np.int32),
+            np.array(roles, dtype=np.uint8),
+            [(p, os.path.getmtime(p)) for p in paths],
+        )
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            lists=self.lists,
+            addresses=self.addresses,
+            indptr=self.indptr,
+            indices=self.indices,
+            roles=self.roles,
+            source_paths=np.array([p for p, _ in self.sources], dtype=str),
+            source_mtimes=np.array([m for _, m in self.sources], dtype=np.float64),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(
+                f["lists"],
+                f["addresses"],
+                f["indptr"],
+                f["indices"],
+                f["roles"],
+                list(zip(f["source_paths"].tolist(), f["source_mtimes"].tolist())),
+            )
+
+    def list_id(self, list_addr):
+        found = np.flatnonzero(self.lists == list_addr.lower())
+        if not found.size:
+            raise KeyError(f"Unknown list {list_addr}")
+        return found[0]
+
+    def lists_per_address(self, role_mask):
+        """Number of lists on which each address has any of the roles in `role_mask`."""
+        has_role = (self.roles & role_mask) != 0
+        return np.bincount(self.indices[has_role], minlength=len(self.addresses))
+
+    def addresses_per_list(self, role_mask, address_mask=None):
+        """Number of addresses with any of the roles in `role_mask` on each list,
+        optionally counting only addresses selected by boolean array `address_mask`."""
+        selected = (self.roles & role_mask) != 0
+        if address_mask is not None:
+            selected &= address_mask[self.indices]
+        return np.bincount(self.entry_lists[selected], minlength=len(self.lists))
+
+    def overlap(self, list_addr, role_mask):
+        """Number of addresses each list shares with `list_addr`."""
+        j = self.list_id(list_addr)
+        start, end = self.indptr[j], self.indptr[j + 1]
+        in_list = np.zeros(len(self.addresses), dtype=bool)
+        in_list[self.indices[start:end][(self.roles[start:end] & role_mask) != 0]] = True
+        return self.addresses_per_list(role_mask, in_list)
+
+
+def get_matrix(pickles, cache):
+    sources = [(p, os.path.getmtime(p)) for p in sorted(pickles)]
+    if cache and os.path.exists(cache):
+        matrix = MembershipMatrix.load(cache)
+        if matrix.sources == sources:
+            logger.debug(f"Using cached matrix {cache}")
+            return matrix
+        logger.info(f"Cached matrix {cache} is out of date")
+    logger.info(f"Building membership matrix from {len(sources)} pickle(s)")
+    matrix = MembershipMatrix.build([p for p, _ in sources])
+    if cache:
+        matrix.save(cache)
+    return matrix
+
+
+def print_top(names, counts, num):
+    order = np.argsort(-counts, kind="stable")[:num]
+    for i in order:
+        if counts[i]:
+            print(f"{counts[i]:8} {names[i]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--mailman-pickles",
+        metavar="PATH",
+        nargs="+",
+        required=True,
+        help="mailman list configuration pickles created by pickle-mailman-list.py",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="PATH",
+        help="NumPy .npz file in which to cache the membership matrix",
+    )
+    parser.add_argument(
+        "--roles",
+        nargs="+",
+        default=["digest", "regular"],
+        choices=list(ROLE_NAMES.values()),
+        help="consider only these roles (default: digest regular)",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="info",
+        choices=("debug", "info", "warning", "error"),
+        help="logging level (default: info)",
+    )
+    subparsers = parser.add_subparsers(dest="query", required=True)
+
+    parser_top = subparsers.add_parser("top-addresses", help="addresses on the most lists")
+    parser_top.add_argument("--exclude-domain", metavar="DOMAIN", help="ignore addresses in DOMAIN")
+    parser_top.add_argument("--num", metavar="NUM", type=int, default=20, help="show top NUM (default: 20)")
+
+    parser_empty = subparsers.add_parser(
+        "empty-after-filter", help="lists that would have no members if restricted to a domain"
+    )
+    parser_empty.add_argument(
+        "--domain", metavar="DOMAIN", default="icecube.wisc.edu", help="(default: icecube.wisc.edu)"
+    )
+
+    parser_overlap = subparsers.add_parser("overlap", help="lists sharing the most addresses with a list")
+    parser_overlap.add_argument("list", metavar="EMAIL", help="list address")
+    parser_overlap.add_argument(
+        "--num", metavar="NUM", type=int, default=20, help="show top NUM (default: 20)"
+    )
+
+    parser_domains = subparsers.add_parser("domains", help="address and membership counts per domain")
+    parser_domains.add_argument(
+        "--num", metavar="NUM", type=int, default=20, help="show top NUM (default: 20)"
+    )
+
+    subparsers.add_parser("roles", help="number of entries with each role, per list")
+
+    args = parser.parse_args()
+
+    logger.setLevel(getattr(logging, args.log_level.upper()))
+    role_mask = 0
+    for bit, name in ROLE_NAMES.items():
+        if name in args.roles:
+            role_mask |= bit
+
+    matrix = get_matrix(args.mailman_pickles, args.cache)
+
+    if args.query == "top-addresses":
+        counts = matrix.lists_per_address(role_mask)
+        if args.exclude_domain:
+            counts[matrix.domains[matrix.domain_ids] == args.exclude_domain.lower()] = 0
+        print_top(matrix.addresses, counts, args.num)
+    elif args.query == "empty-after-filter":
+        in_domain = matrix.domains[matrix.domain_ids] == args.domain.lower()
+        total = matrix.addresses_per_list(role_mask)
+        remaining = matrix.addresses_per_list(role_mask, in_domain)
+        for j in np.flatnonzero((remaining == 0) & (total > 0)):
+            print(f"{total[j]:8} {matrix.lists[j]}")
+    elif args.query == "overlap":
+        try:
+            counts = matrix.overlap(args.list, role_mask)
+        except KeyError as e:
+            parser.error(e.args[0])
+        counts[matrix.list_id(args.list)] = 0
+        print_top(matrix.lists, counts, args.num)
+    elif args.query == "domains":
+        counts = matrix.lists_per_address(role_mask)
+        addresses = np.bincount(matrix.domain_ids, weights=counts > 0, minlength=len(matrix.domains))
+        memberships = np.bincount(matrix.domain_ids, weights=counts, minlength=len(matrix.domains))
+        for i in np.argsort(-memberships, kind="stable")[: args.num]:
+            if memberships[i]:
+                print(f"{int(addresses[i]):8} {int(memberships[i]):8} {matrix.domains[i]}")
+    elif args.query == "roles":
+        names = list(ROLE_NAMES.values())
+        print(" ".join(f"{n:>9}" for n in names), "list")
+        by_role = [matrix.addresses_per_list(bit) for bit in ROLE_NAMES]
+        for j, list_addr in enumerate(matrix.lists):
+            print(" ".join(f"{c[j]:9}" for c in by_role), list_addr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
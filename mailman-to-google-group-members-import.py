@@ -1,14 +1,102 @@
 #!/usr/bin/env python
 import argparse
+import collections
+import concurrent.futures
 import sys
 import logging
-import pickle
 import re
 from google.oauth2 import service_account
-from googleapiclient import discovery
 from googleapiclient.errors import HttpError
 
-from utils import get_google_group_config_from_mailman_config
+from utils import (
+    ThreadLocalGoogleService,
+    get_google_group_config_from_mailman_config,
+    open_mailman_list,
+    start_logging,
+    stop_logging,
+)
+
+# Retries (with exponential backoff, done by googleapiclient) of requests that
+# fail because of rate limiting (429, 403 rateLimitExceeded) or server errors.
+# More threads make hitting the rate limit more likely.
+NUM_RETRIES = 5
+
+
+class OrderedMemberWriter:
+    """Run Google member operations on a pool of threads.
+
+    Every worker thread uses its own service object (see ThreadLocalGoogleService).
+
+    Submitted tasks are called with the worker's `members` resource and must
+    return a list of (level, message, member_event) tuples (see
+    MemberProgressHandler; member_event may be None). Messages are logged in the
+    order in which tasks were submitted, regardless of completion order.
+    At most a few tasks per thread are kept in flight, so that submitting
+    from a streamed member list does not read ahead of the workers.
+    """
+
+    def __init__(self, creds, num_threads):
+        self.directory = ThreadLocalGoogleService(creds, "admin", "directory_v1")
+        self.max_pending = 4 * num_threads
+        self.pending = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+
+    def _members(self):
+        return self.directory.get().members()
+
+    def _run(self, func, args):
+        return func(self._members(), *args)
+
+    def submit(self, func, *args):
+        self._enqueue(self.executor.submit(self._run, func, args))
+
+    def log(self, level, msg, member_event=None):
+        """Log `msg` in order with the messages of tasks submitted so far."""
+        future = concurrent.futures.Future()
+        future.set_result([(level, msg, member_event)])
+        self._enqueue(future)
+
+    def _enqueue(self, future):
+        self.pending.append(future)
+        while len(self.pending) >= self.max_pending or (self.pending and self.pending[0].done()):
+            self._log_next()
+
+    def _log_next(self):
+        for level, msg, member_event in self.pending.popleft().result():
+            logging.log(level, msg, extra={"member_event": member_event})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                while self.pending:
+                    self._log_next()
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.directory.close()
+
+
+def insert_member(members, group_email, body, msg, conflict_warning=None):
+    """Insert a group member and return messages to log.
+
+    If the member already exists and `conflict_warning` is given, it is
+    logged and the conflict is otherwise ignored, as are all other errors.
+    Without `conflict_warning`, errors other than a conflict are raised.
+    """
+    try:
+        members.insert(groupKey=group_email, body=body).execute(num_retries=NUM_RETRIES)
+    except HttpError as e:
+        if e.status_code != 409 and not conflict_warning:  # 409: entity already exists
+            raise
+        log = [(logging.INFO, msg, None)]  # not counted as inserted
+        if e.status_code == 409:
+            log.append((logging.ERROR, f"User {body['email']} already part of the group", "conflict"))
+            if conflict_warning:
+                log.append((logging.WARNING, conflict_warning, None))
+        return log
+    return [(logging.INFO, msg, "inserted")]
 
 
 def main():
@@ -25,7 +113,8 @@ def main():
         "--mailman-pickle",
         metavar="PATH",
         required=True,
-        help="mailman list configuration pickle created by pickle-mailman-list.py",
+        help="mailman list configuration pickle created by pickle-mailman-list.py,\n"
+        "or - to read the output of `pickle-mailman-list.py --stream` from stdin",
     )
     parser.add_argument(
         "--ignore",
@@ -46,12 +135,32 @@ def main():
         required=True,
         help="the principal whom the service account will impersonate³",
     )
+    parser.add_argument(
+        "--threads",
+        metavar="NUM",
+        type=int,
+        default=1,
+        help="number of threads that insert members concurrently (default: 1)",
+    )
     parser.add_argument(
         "--log-level",
         default="info",
         choices=("debug", "info", "warning", "error"),
         help="logging level (default: info)",
     )
+    parser.add_argument(
+        "--log-json",
+        metavar="PATH",
+        help="also write all log messages to PATH as JSON lines",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        metavar="SECONDS",
+        type=float,
+        default=10,
+        help="unless the logging level is debug, replace per-member messages\n"
+        "with counts logged every SECONDS (default: 10)",
+    )
     parser.add_argument(
         "--browser-google-account-index",
         metavar="NUM",
@@ -64,14 +173,28 @@ def main():
     )
     args = parser.parse_args()
 
-    logging.basicConfig(
-        level=getattr(logging, args.log_level.upper()),
-        format="%(levelname)s %(message)s",
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+    log_listener = start_logging(
+        logging.getLogger(),
+        console_handler,
+        args.log_json,
+        None if args.log_level == "debug" else args.progress_interval,
     )
+    try:
+        import_members(args)
+    finally:
+        stop_logging(log_listener)
+
+
+def import_members(args):
 
     logging.info(f"Retrieving mailman list configuration from {args.mailman_pickle}")
-    with open(args.mailman_pickle, "rb") as f:
-        mmcfg = pickle.load(f)
+    mmcfg, mm_members = open_mailman_list(args.mailman_pickle)
 
     logging.info("Converting mailman list settings to google group settings")
     ggcfg = get_google_group_config_from_mailman_config(mmcfg)
@@ -81,84 +204,56 @@ def main():
         args.sa_creds, scopes=scopes, subject=args.sa_delegate
     )
 
-    svc = discovery.build("admin", "directory_v1", credentials=creds, cache_discovery=False)
-    members = svc.members()
-
     # The flow for populating members and designating managers is a little
     # weird to work around a Google API bug where members.get() fails sometimes:
     # https://stackoverflow.com/questions/66992809/google-admin-sdk-directory-api-members-get-returns-a-404-for-member-email-but
 
-    for member in mmcfg["digest_members"]:
-        if member in args.ignore:
-            logging.info(f"Skipping digest member {member} (on the ignore list)")
-            continue
-        body = {"email": member, "delivery_settings": "DIGEST"}
-        if member in mmcfg["owner"]:
-            logging.info(f"Inserting digest member {member} (manager)")
-            body["role"] = "MANAGER"
-        else:
-            logging.info(f"Inserting digest member {member}")
-        try:
-            members.insert(groupKey=ggcfg["email"], body=body).execute()
-        except HttpError as e:
-            if e.status_code == 409:  # entity already exists
-                logging.error(f"User {member} already part of the group")
+    with OrderedMemberWriter(creds, args.threads) as writer:
+        for kind, member in mm_members:
+            if kind == "digest_member":
+                desc, delivery = "digest member", "DIGEST"
             else:
-                raise
-
-    for member in mmcfg["regular_members"]:
-        if member in args.ignore:
-            logging.info(f"Skipping member {member} (on the ignore list)")
-            continue
-        body = {"email": member, "delivery_settings": "ALL_MAIL"}
-        if member in mmcfg["owner"]:
-            logging.info(f"Inserting member {member} (manager)")
-            body["role"] = "MANAGER"
-        else:
-            logging.info(f"Inserting member {member}")
-        try:
-            members.insert(groupKey=ggcfg["email"], body=body).execute()
-        except HttpError as e:
-            if e.status_code == 409:  # entity already exists
-                logging.error(f"User {member} already part of the group")
+                desc, delivery = "member", "ALL_MAIL"
+            if member in args.ignore:
+                writer.log(logging.INFO, f"Skipping {desc} {member} (on the ignore list)", "skipped")
+                continue
+            body = {"email": member, "delivery_settings": delivery}
+            if member in mmcfg["owner"]:
+                body["role"] = "MANAGER"
+                msg = f"Inserting {desc} {member} (manager)"
             else:
-                raise
+                msg = f"Inserting {desc} {member}"
+            writer.submit(insert_member, ggcfg["email"], body, msg)
 
-    for owner in set(mmcfg["owner"]) - set(mmcfg["digest_members"] + mmcfg["regular_members"]):
-        if owner in args.ignore:
-            logging.info(f"Skipping non-member manager {owner} (on the ignore list)")
-            continue
-        logging.info(f"Inserting non-member manager {owner}")
-        try:
-            members.insert(
-                groupKey=ggcfg["email"],
-                body={"email": owner, "role": "MANAGER", "delivery_settings": "NONE"},
-            ).execute()
-        except HttpError as e:
-            if e.status_code == 409:  # entity already exists
-                logging.error(f"User {owner} already part of the group")
-                logging.warning(f"!!!  CONFIGURE AS MANAGER MANUALLY: {owner}")
-
-    email_regex = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
-    for nonmember in mmcfg["accept_these_nonmembers"]:
-        if nonmember in args.ignore:
-            logging.info(f"Skipping non-member {nonmember} (on the ignore list)")
-            continue
-        if not re.match(email_regex, nonmember):
-            logging.warning(f"Ignoring invalid non-member email {nonmember}")
-            continue
-        logging.info(f"Inserting non-member {nonmember}")
-        try:
-            members.insert(
-                groupKey=ggcfg["email"],
-                body={"email": nonmember, "delivery_settings": "NONE"},
-            ).execute()
-        except HttpError as e:
-            if e.status_code == 409:  # entity already exists
-                logging.error(f"User {nonmember} already part of the group")
-                logging.warning(f"!!!  RESOLVE CONFLICT MANUALLY FOR: {nonmember}")
-
-    svc.close()
+        for owner in set(mmcfg["owner"]) - set(mmcfg["digest_members"] + mmcfg["regular_members"]):
+            if owner in args.ignore:
+                writer.log(
+                    logging.INFO, f"Skipping non-member manager {owner} (on the ignore list)", "skipped"
+                )
+                continue
+            writer.submit(
+                insert_member,
+                ggcfg["email"],
+                {"email": owner, "role": "MANAGER", "delivery_settings": "NONE"},
+                f"Inserting non-member manager {owner}",
+                f"!!!  CONFIGURE AS MANAGER MANUALLY: {owner}",
+            )
+
+        email_regex = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
+        for nonmember in mmcfg["accept_these_nonmembers"]:
+            if nonmember in args.ignore:
+                writer.log(logging.INFO, f"Skipping non-member {nonmember} (on the ignore list)", "skipped")
+                continue
+            if not re.match(email_regex, nonmember):
+                writer.log(logging.WARNING, f"Ignoring invalid non-member email {nonmember}", "invalid")
+                continue
+            writer.submit(
+                insert_member,
+                ggcfg["email"],
+                {"email": nonmember, "delivery_settings": "NONE"},
+                f"Inserting non-member {nonmember}",
+                f"!!!  RESOLVE CONFLICT MANUALLY FOR: {nonmember}",
+            )
 
     addr, domain = ggcfg["email"].split("@")
     logging.info(
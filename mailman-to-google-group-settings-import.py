@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 import argparse
 import sys
-import pickle
 import colorlog
 import logging
 from pprint import pformat
@@ -9,7 +8,11 @@ from google.oauth2 import service_account
 from googleapiclient import discovery
 from googleapiclient.errors import HttpError
 
-from utils import get_google_group_config_from_mailman_config
+from utils import (
+    get_google_group_config_from_mailman_config,
+    load_mailman_list,
+    set_controlled_mailing_list_setting,
+)
 
 
 handler = colorlog.StreamHandler()
@@ -19,29 +22,6 @@ logger.propagate = False
 logger.addHandler(handler)
 
 
-def set_controlled_mailing_list_setting(ggcfg):
-    def _override(cfg, key, value):
-        if key not in cfg:
-            logger.warning(f"Setting {key} to be '{value}'")
-        elif cfg[key] != value:
-            logger.warning(f"Overriding {key} from '{cfg[key]}' to '{value}'")
-        cfg[key] = value
-
-    _override(ggcfg, "whoCanJoin", "INVITED_CAN_JOIN")
-    _override(ggcfg, "whoCanViewGroup", "ALL_MEMBERS_CAN_VIEW")
-    _override(ggcfg, "whoCanLeaveGroup", "NONE_CAN_LEAVE")
-    _override(ggcfg, "includeCustomFooter", "true")
-    _override(
-        ggcfg,
-        "customFooterText",
-        "Message archives are on https://groups.google.com (log in with your IceCube account)\n"
-        "To unsubscribe, use group membership management interface of https://user-management.icecube.aq",
-    )
-    _override(ggcfg, "whoCanModerateMembers", "NONE")
-
-    return ggcfg
-
-
 def summarize_settings(ggcfg):
     logger.info(f"whoCanViewGroup = {ggcfg['whoCanViewGroup']}")
     logger.info(f"whoCanViewMembership = {ggcfg['whoCanViewMembership']}")
@@ -67,7 +47,8 @@ def main():
         "--mailman-pickle",
         metavar="PATH",
         required=True,
-        help="mailman list configuration pickle created by pickle-mailman-list.py",
+        help="mailman list configuration pickle created by pickle-mailman-list.py,\n"
+        "or - to read the output of `pickle-mailman-list.py --stream` from stdin",
     )
     parser.add_argument(
         "--controlled-mailing-list",
@@ -115,8 +96,7 @@ def main():
     )
 
     logger.info(f"Retrieving mailman list configuration from {args.mailman_pickle}")
-    with open(args.mailman_pickle, "rb") as f:
-        mmcfg = pickle.load(f)
+    mmcfg = load_mailman_list(args.mailman_pickle)
 
     logger.debug(pformat(mmcfg))
     logger.info("Converting mailman list settings to google group settings")
@@ -124,7 +104,7 @@ def main():
     logger.debug(pformat(ggcfg))
 
     if args.controlled_mailing_list:
-        ggcfg = set_controlled_mailing_list_setting(ggcfg)
+        ggcfg = set_controlled_mailing_list_setting(ggcfg, logger)
 
     summarize_settings(ggcfg)
 
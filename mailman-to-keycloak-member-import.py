@@ -1,105 +1,23 @@
 #!/usr/bin/env python
 import argparse
 import asyncio
+import itertools
 import logging
-import pickle
 import re
-import smtplib
 import sys
 
-from email.message import EmailMessage
-
 from krs.token import get_rest_client
-from krs.groups import create_group, add_user_group
-from krs.users import list_users
-
-FULL_INSTRUCTIONS_MESSAGE = """
-You are receiving this messages because you need to take action to
-ensure uninterrupted delivery of messages from mailing list {list_addr}.
-
-Please ignore this email if it is a duplicate and you have already
-taken the required actions.
-
-In the near future this mailing list will become restricted to
-active members of {experiment_list} experiment(s),
-and require subscribers to either use their IceCube email address
-or configure a custom email address in their profile to be used
-for all mailing lists whose membership management is automated.
-
-You are currently subscribed to {list_addr} using
-{user_addr}, which is either a non-IceCube, or a disallowed email
-address, or you are not a member of an institution belonging to
-{experiment_list} experiment(s).
-
-In order to remain subscribed to {list_addr} after enforcement
-of membership restrictions begins you must:
-
-(1) If you prefer to use a non-IceCube email for ALL automatically-
-    managed mailing lists, you must configure it in your user profile.
-    (Skip this step if you want to use your IceCube address.)
-    - Go to https://user-management.icecube.aq and log in using
-      your IceCube credentials.
-    - Under "My profile", fill in "mailing_list_email" field and
-      click "Update".
-
-(2) Ensure that you are a member of an institution belonging to
-    one of {experiment_list} experiment(s).
-    - Go to https://user-management.icecube.aq and log in using
-      your IceCube credentials.
-    - Check your experiments under "Experiments/Institutions".
-    - If necessary, click "Join an institution", select an experiment
-      and an institution, and click "Submit Join Request".
-      Wait until your request is approved before proceeding
-      to step 3.
-
-(3) Join the mailing list group corresponding to this list.
-    - Go to https://user-management.icecube.aq and log in using
-      your IceCube credentials.
-    - Under "Groups" at the bottom of the page, click "Join a group"
-    - Select the appropriate group (look for prefix "/mail/")
-    - Click "Submit Join Request"
-
-In order to avoid a disruption in receiving of messages from
-{list_addr} once it becomes restricted,
-you must complete the steps above, and your requests
-must be approved prior to the transition.
-
-Taking the steps above will not affect your current subscription,
-so we recommend completing them soon, since it may take some time
-for requests to get approved.
-
-If you have questions or need help, please email help@icecube.wisc.edu.
-"""
-
-OWNER_INSTRUCTIONS_MESSAGE = """
-You are receiving this message because you are registered as an owner of
-{list_addr} using {user_addr}, which is either
-a non-IceCube or a disallowed email address.
-
-In the near future this mailing list will become restricted to
-active members of {experiment_list} experiment(s),
-and only allow either IceCube email addresses or addresses registered
-in the user profile attribute "mailing_list_email". This will apply
-to owners as well.
- 
-In order to remain an owner of {list_addr}
-after the transition, you must send a request to help@icecube.wisc.edu.
-For example:
-
-Please make <YOUR_ICECUBE_USERNAME> an administrator of the
-controlled mailing list {list_addr}.
-
-Once your reqeust is acted upon and you are added to the mailing list
-as an owner, if you would rather not receive {list_addr}
-traffic, or if you later set "mailing_list_email" attribute on
-https://user-management.icecube.aq and find yourself receiving duplicate
-emails, you can selectively stop mail delivery by going to
-https://groups.google.com, logging on with your IceCube account and
-changing "Subscription" value associated with {list_addr}
-from "Each email" to "No Email".
-
-If you have questions or need help, please email help@icecube.wisc.edu.
-"""
+from krs.groups import GroupDoesNotExist, list_groups
+from krs.users import UserDoesNotExist, list_users
+
+from utils import (
+    FULL_INSTRUCTIONS_MESSAGE,
+    OWNER_INSTRUCTIONS_MESSAGE,
+    open_mailman_list,
+    send_email,
+    start_logging,
+    stop_logging,
+)
 
 logger = logging.getLogger("member-import")
 logger.propagate = False
@@ -115,51 +33,129 @@ class ColorLoggingFormatter(logging.Formatter):
         reset = "\x1b[0m"
         fmt = "%(levelname)s: %(message)s"
 
-        self.FORMATS = {
-            logging.DEBUG: fmt + f" [dryrun={dryrun}]",
-            logging.INFO: fmt + f" [dryrun={dryrun}]",
-            logging.WARNING: yellow + fmt + f" [dryrun={dryrun}]" + reset,
-            logging.ERROR: red + fmt + f" [dryrun={dryrun}]" + reset,
-            logging.CRITICAL: inv_red + fmt + f" [dryrun={dryrun}]" + reset,
+        self.FORMATTERS = {
+            logging.DEBUG: logging.Formatter(fmt + f" [dryrun={dryrun}]"),
+            logging.INFO: logging.Formatter(fmt + f" [dryrun={dryrun}]"),
+            logging.WARNING: logging.Formatter(yellow + fmt + f" [dryrun={dryrun}]" + reset),
+            logging.ERROR: logging.Formatter(red + fmt + f" [dryrun={dryrun}]" + reset),
+            logging.CRITICAL: logging.Formatter(inv_red + fmt + f" [dryrun={dryrun}]" + reset),
         }
 
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self.FORMATTERS.get(record.levelno, self.FORMATTERS[logging.INFO])
         return formatter.format(record)
 
 
-def send_email(smtp_host, to, subj, message):
-    msg = EmailMessage()
-    msg["Subject"] = subj
-    msg["From"] = "no-reply@icecube.wisc.edu"
-    msg["To"] = to
-    msg.set_content(message)
-    with smtplib.SMTP(smtp_host) as s:
-        s.send_message(msg)
+class ListLoggerAdapter(logging.LoggerAdapter):
+    """Prefix messages with the group being populated, since several lists may
+    be imported concurrently. Unlike the default adapter, keep the caller's `extra`."""
+
+    def process(self, msg, kwargs):
+        return f"{self.extra['group']}: {msg}", kwargs
+
+
+class KeycloakProvisioner:
+    """Create KeyCloak groups and add group members for any number of lists,
+    sharing one REST client (and its keep-alive HTTP session), one group tree
+    lookup and one user list lookup.
+    """
+
+    def __init__(self, keycloak, concurrency, dryrun):
+        self.keycloak = keycloak
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.dryrun = dryrun
+        self.groups = {}
+        self.created = set()
+        self.all_users = {}
+
+    async def prepare(self, keycloak_groups):
+        """Create `keycloak_groups` and their _admin subgroups, if necessary,
+        and retrieve info of all users.
+
+        Returns:
+            set: paths of groups that could not be created
+        """
+        self.groups = await list_groups(rest_client=self.keycloak)
+        wanted = {path for group in keycloak_groups for path in (group, group + "/_admin")}
+        missing = sorted(wanted - set(self.groups), key=lambda p: p.count("/"))
+        failed = set()
+        # Create groups one tree level at a time, so that parents exist before their children.
+        # If a parent can't be created, creating its children fails too.
+        for _, level in itertools.groupby(missing, key=lambda p: p.count("/")):
+            level = list(level)
+            for path in level:
+                logger.info(f"Creating KeyCloak group {path}")
+            if not self.dryrun:
+                results = await asyncio.gather(
+                    *(self._create_group(path) for path in level), return_exceptions=True
+                )
+                for path, result in zip(level, results):
+                    if isinstance(result, Exception):
+                        logger.error(f"Failed to create KeyCloak group {path}: {result}")
+                        failed.add(path)
+                self.groups = await list_groups(rest_client=self.keycloak)
+            self.created.update(path for path in level if path not in failed)
+
+        logger.info(f"Retrieving info of all users from KeyCloak")
+        self.all_users = await list_users(rest_client=self.keycloak)
+        return failed
+
+    async def _create_group(self, path):
+        parent, name = path.rsplit("/", 1)
+        if parent and parent not in self.groups:
+            raise GroupDoesNotExist(f"parent group {parent} does not exist")
+        url = f"/groups/{self.groups[parent]['id']}/children" if parent else "/groups"
+        async with self.semaphore:
+            await self.keycloak.request("POST", url, {"name": name})
+
+    async def add_user(self, group_path, username):
+        """Add `username` to `group_path`, like krs.groups.add_user_group(), but using
+        the group tree and user info retrieved by prepare() instead of fetching them
+        again for every addition."""
+        if group_path not in self.groups:
+            raise GroupDoesNotExist(f'group "{group_path}" does not exist')
+        if username not in self.all_users:
+            raise UserDoesNotExist(f'user "{username}" does not exist')
+        user_url = f"/users/{self.all_users[username]['id']}/groups"
+        group_url = f"{user_url}/{self.groups[group_path]['id']}"
+        async with self.semaphore:
+            if group_path in self.created:
+                # Users are added to a group before being added to its _admin subgroup,
+                # so nobody can be in a subgroup of a group created by this run yet.
+                await self.keycloak.request("PUT", group_url)
+                return
+            membership = [g["path"] for g in await self.keycloak.request("GET", user_url)]
+            if group_path in membership:
+                return
+            # Adding a user to a group drops their membership in its subgroups, so
+            # remove and re-add it (https://issues.redhat.com/browse/KEYCLOAK-11298).
+            subgroups = [self.groups[g]["id"] for g in membership if g.startswith(group_path + "/")]
+            for subgroup_id in subgroups:
+                await self.keycloak.request("DELETE", f"{user_url}/{subgroup_id}")
+            await self.keycloak.request("PUT", group_url)
+            for subgroup_id in subgroups:
+                await self.keycloak.request("PUT", f"{user_url}/{subgroup_id}")
 
 
 async def mailman_to_keycloak_member_import(
     mmcfg,
+    mm_members,
     keycloak_group,
     mail_server,
     required_experiments,
     extra_admins,
-    keycloak,
+    provisioner,
     email_dry_run,
     dryrun,
 ):
-    logger.info("Creating KeyCloak groups")
-    if not dryrun:
-        await create_group(keycloak_group, rest_client=keycloak)
-        await create_group(keycloak_group + "/_admin", rest_client=keycloak)
-    for username in extra_admins:
-        logger.info(f"Adding extra admin {username}")
-        if not dryrun:
-            await add_user_group(keycloak_group + "/_admin", username, rest_client=keycloak)
-
-    logger.info(f"Retrieving info of all users from KeyCloak")
-    all_users = await list_users(rest_client=keycloak)
+    """Populate `keycloak_group`, which `provisioner.prepare()` must have created,
+    and send instructions to subscribers and owners who can't be added.
+
+    Members are added while `mm_members` is being read. Users who can't be
+    added are logged, and an exception is raised once everything else is done.
+    """
+    log = ListLoggerAdapter(logger, {"group": keycloak_group})
+    all_users = provisioner.all_users
     username_from_canon_addr = {
         u["attributes"]["canonical_email"]: u["username"]
         for u in all_users.values()
@@ -170,40 +166,73 @@ async def mailman_to_keycloak_member_import(
     email_regex = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
     for nonmember in mmcfg["accept_these_nonmembers"]:
         if re.match(email_regex, nonmember):
-            logger.info(f"Found valid non-member address {nonmember}")
+            log.info(f"Found valid non-member address {nonmember}", extra={"member_event": "valid nonmember"})
             allowed_non_members.append(nonmember)
         else:
-            logger.info(f"Ignoring invalid non-member email {nonmember}")
+            log.info(
+                f"Ignoring invalid non-member email {nonmember}", extra={"member_event": "invalid nonmember"}
+            )
 
+    failures = 0
+
+    async def _add_user(group_path, username, member_event):
+        nonlocal failures
+        try:
+            await provisioner.add_user(group_path, username)
+        except Exception as e:
+            log.error(f"Failed to add {username} to {group_path}: {e}")
+            failures += 1
+        else:
+            log.info(f"Added {username} to {group_path}", extra={"member_event": member_event})
+
+    member_adds = []
     send_regular_instructions_to = set()
-    for email in mmcfg["digest_members"] + mmcfg["regular_members"] + allowed_non_members:
+    subscribers = itertools.chain((email for _, email in mm_members), allowed_non_members)
+    # Reading a stream blocks, so do it in a thread, letting additions proceed meanwhile
+    while (email := await asyncio.to_thread(next, subscribers, None)) is not None:
         username, domain = email.split("@")
         if domain == "icecube.wisc.edu":
             username = username_from_canon_addr.get(email, username)
             if username not in all_users:
-                logger.warning(f"Unknown user {email}")
+                log.warning(f"Unknown user {email}", extra={"member_event": "unknown member"})
                 send_regular_instructions_to.add(email)
                 continue
-            logger.info(f"Adding {username} as MEMBER")
+            log.info(f"Adding {username} as MEMBER", extra={"member_event": "member queued"})
             if not dryrun:
-                await add_user_group(keycloak_group, username, rest_client=keycloak)
+                member_adds.append(asyncio.create_task(_add_user(keycloak_group, username, "member added")))
         else:
-            logger.info(f"Add non-icecube member {email} to list of instructions recipients")
+            log.info(
+                f"Add non-icecube member {email} to list of instructions recipients",
+                extra={"member_event": "non-icecube member"},
+            )
             send_regular_instructions_to.add(email)
+    await asyncio.gather(*member_adds)
 
     for email in send_regular_instructions_to:
-        logger.info(f"Sending MEMBER instructions to {email} [email_dry_run={email_dry_run}]")
-        if not dryrun and not email_dry_run:
-            send_email(
-                mail_server,
-                email,
-                f"Important information about membership in mailing list {mmcfg['email']}",
-                FULL_INSTRUCTIONS_MESSAGE.format(
-                    list_addr=mmcfg["email"],
-                    user_addr=email,
-                    experiment_list=", ".join(required_experiments),
-                ),
+        if dryrun or email_dry_run:
+            log.info(
+                f"Not sending MEMBER instructions to {email} [email_dry_run={email_dry_run}]",
+                extra={"member_event": "instructions not sent (dry run)"},
             )
+            continue
+        await asyncio.to_thread(
+            send_email,
+            mail_server,
+            email,
+            f"Important information about membership in mailing list {mmcfg['email']}",
+            FULL_INSTRUCTIONS_MESSAGE.format(
+                list_addr=mmcfg["email"],
+                user_addr=email,
+                experiment_list=", ".join(required_experiments),
+            ),
+        )
+        log.info(f"Sent MEMBER instructions to {email}", extra={"member_event": "member instructions sent"})
+
+    owner_adds = []
+    for username in extra_admins:
+        log.info(f"Adding extra admin {username}")
+        if not dryrun:
+            owner_adds.append(_add_user(keycloak_group + "/_admin", username, "extra admin added"))
 
     send_owner_instructions_to = set()
     for email in mmcfg["owner"]:
@@ -211,29 +240,77 @@ async def mailman_to_keycloak_member_import(
         if domain == "icecube.wisc.edu":
             username = username_from_canon_addr.get(email, username)
             if username not in all_users:
-                logger.warning(f"Unknown owner {email}")
+                log.warning(f"Unknown owner {email}", extra={"member_event": "unknown owner"})
                 send_owner_instructions_to.add(email)
                 continue
-            logger.info(f"Adding {username} as OWNER")
+            log.info(f"Adding {username} as OWNER", extra={"member_event": "owner queued"})
             if not dryrun:
-                await add_user_group(keycloak_group + "/_admin", username, rest_client=keycloak)
+                owner_adds.append(_add_user(keycloak_group + "/_admin", username, "owner added"))
         else:
-            logger.info(f"Non-icecube owner {email}")
+            log.info(f"Non-icecube owner {email}", extra={"member_event": "non-icecube owner"})
             send_owner_instructions_to.add(email)
+    await asyncio.gather(*owner_adds)
 
     for email in send_owner_instructions_to:
-        logger.info(f"Sending OWNER instructions to {email} [email_dry_run={email_dry_run}]")
-        if not dryrun and not email_dry_run:
-            send_email(
-                mail_server,
-                email,
-                f"Important information about ownership of mailing list {mmcfg['email']}",
-                OWNER_INSTRUCTIONS_MESSAGE.format(
-                    list_addr=mmcfg["email"],
-                    user_addr=email,
-                    experiment_list=", ".join(required_experiments),
-                ),
+        if dryrun or email_dry_run:
+            log.info(
+                f"Not sending OWNER instructions to {email} [email_dry_run={email_dry_run}]",
+                extra={"member_event": "instructions not sent (dry run)"},
             )
+            continue
+        await asyncio.to_thread(
+            send_email,
+            mail_server,
+            email,
+            f"Important information about ownership of mailing list {mmcfg['email']}",
+            OWNER_INSTRUCTIONS_MESSAGE.format(
+                list_addr=mmcfg["email"],
+                user_addr=email,
+                experiment_list=", ".join(required_experiments),
+            ),
+        )
+        log.info(f"Sent OWNER instructions to {email}", extra={"member_event": "owner instructions sent"})
+
+    if failures:
+        raise RuntimeError(f"{failures} KeyCloak group addition(s) failed")
+
+
+async def provision(lists, args, keycloak):
+    provisioner = KeycloakProvisioner(keycloak, args.concurrency, args.dry_run)
+    failed_groups = await provisioner.prepare([keycloak_group for _, keycloak_group in lists])
+
+    async def _import(mailman_pickle, keycloak_group):
+        if {keycloak_group, keycloak_group + "/_admin"} & failed_groups:
+            logger.error(f"{keycloak_group}: skipping {mailman_pickle} (group could not be created)")
+            return False
+        try:
+            logger.info(f"Loading mailman list configuration from {mailman_pickle}")
+            mmcfg, mm_members = await asyncio.to_thread(open_mailman_list, mailman_pickle)
+            await mailman_to_keycloak_member_import(
+                mmcfg,
+                mm_members,
+                keycloak_group,
+                args.mail_server,
+                args.required_experiments,
+                args.extra_admins,
+                provisioner,
+                args.email_dry_run,
+                args.dry_run,
+            )
+        except Exception:
+            # Don't let one list abort the import of all the others
+            logger.exception(f"{keycloak_group}: import of {mailman_pickle} failed")
+            return False
+        return True
+
+    results = await asyncio.gather(
+        *(_import(mailman_pickle, keycloak_group) for mailman_pickle, keycloak_group in lists)
+    )
+    failed = [keycloak_group for (_, keycloak_group), ok in zip(lists, results) if not ok]
+    logger.info(f"Imported {len(lists) - len(failed)} of {len(lists)} list(s)")
+    if failed:
+        logger.error(f"Import failed for: {', '.join(failed)}")
+    return not failed
 
 
 def main():
@@ -251,15 +328,27 @@ def main():
     parser.add_argument(
         "--mailman-pickle",
         metavar="PATH",
-        required=True,
-        help="mailman list configuration pickle file created by pickle-mailman-list.py",
+        help="mailman list configuration pickle file created by pickle-mailman-list.py, "
+        "or - to read the output of `pickle-mailman-list.py --stream` from stdin",
     )
     parser.add_argument(
         "--keycloak-group",
         metavar="PATH",
-        required=True,
         help="path to the KeyCloak group to populate",
     )
+    parser.add_argument(
+        "--bulk",
+        metavar="PATH",
+        help="instead of --mailman-pickle and --keycloak-group, import all lists in PATH, "
+        "a file with a pickle path and a KeyCloak group path on every line",
+    )
+    parser.add_argument(
+        "--concurrency",
+        metavar="NUM",
+        type=int,
+        default=8,
+        help="maximum number of concurrent KeyCloak requests",
+    )
     parser.add_argument(
         "--required-experiments",
         metavar="NAME",
@@ -297,34 +386,57 @@ def main():
         choices=("debug", "info", "warning", "error"),
         help="logging level: debug, info, warning, error",
     )
+    parser.add_argument(
+        "--log-json",
+        metavar="PATH",
+        help="also write all log messages to PATH as JSON lines",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        metavar="SECONDS",
+        type=float,
+        default=10,
+        help="unless the logging level is debug, replace per-member messages "
+        "with counts logged every SECONDS",
+    )
     args = parser.parse_args()
 
+    if args.bulk:
+        if args.mailman_pickle or args.keycloak_group:
+            parser.error("--bulk can't be used with --mailman-pickle or --keycloak-group")
+        with open(args.bulk) as f:
+            lists = [tuple(line.split()) for line in f if line.strip() and not line.startswith("#")]
+        if any(len(pair) != 2 or pair[0] == "-" for pair in lists):
+            parser.error(f"{args.bulk} must contain a pickle file and a KeyCloak group on every line")
+    elif args.mailman_pickle and args.keycloak_group:
+        lists = [(args.mailman_pickle, args.keycloak_group)]
+    else:
+        parser.error("either --bulk, or --mailman-pickle and --keycloak-group are required")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+
     logging.basicConfig(level=getattr(logging, args.log_level.upper()))
     handler = logging.StreamHandler()
     handler.setFormatter(ColorLoggingFormatter(dryrun=args.dry_run))
-    logger.addHandler(handler)
+    log_listener = start_logging(
+        logger,
+        handler,
+        args.log_json,
+        None if args.log_level == "debug" else args.progress_interval,
+    )
     if args.log_level == "info":
         ClientCredentialsAuth = logging.getLogger("ClientCredentialsAuth")
         ClientCredentialsAuth.setLevel(logging.WARNING)  # too noisy
-
-    logger.info(f"Loading mailman list configuration from {args.mailman_pickle}")
-    with open(args.mailman_pickle, "rb") as f:
-        mmcfg = pickle.load(f)
+        krs_groups = logging.getLogger("krs.groups")
+        krs_groups.setLevel(logging.WARNING)  # logs every added user
 
     keycloak = get_rest_client()
 
-    asyncio.run(
-        mailman_to_keycloak_member_import(
-            mmcfg,
-            args.keycloak_group,
-            args.mail_server,
-            args.required_experiments,
-            args.extra_admins,
-            keycloak,
-            args.email_dry_run,
-            args.dry_run,
-        )
-    )
+    try:
+        if not asyncio.run(provision(lists, args, keycloak)):
+            return 1
+    finally:
+        stop_logging(log_listener)
 
 
 if __name__ == "__main__":
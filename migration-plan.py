@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+"""
+Plan migration of a mailman list offline, review the plan, then apply it.
+
+`plan` turns a list snapshot created by `pickle-mailman-list.py` (and, for
+KeyCloak, a cache of KeyCloak users created by `cache-keycloak-users`) into
+a JSON-lines file of operations: Google group creation and configuration,
+Google member inserts, KeyCloak group creation and membership, and
+instructional emails. It makes the same decisions as the individual
+importers, but without touching any service.
+
+`apply` executes one or more plans. Operations whose dependencies have
+completed run concurrently. Every completed operation is recorded in a
+journal file, and applying the same plan again skips operations found in
+the journal, so an interrupted run can simply be restarted. Google and
+KeyCloak operations are themselves idempotent (e.g. inserting a member that
+already exists patches its role and delivery to the planned values), but
+emails are not: without the journal, or if a run is interrupted between
+sending an email and recording it, the email is sent again.
+
+Addresses are lower-cased, so that the same address spelled differently in
+mailman results in a single operation. Use `apply --email-dry-run` to log emails instead of sending
+them; such emails are not recorded in the journal.
+"""
+
+import argparse
+import asyncio
+import colorlog
+import json
+import logging
+import os
+import re
+import sys
+from google.oauth2 import service_account
+from googleapiclient.errors import HttpError
+
+from krs.token import get_rest_client
+from krs.groups import create_group, add_user_group
+from krs.users import list_users
+
+from utils import (
+    FULL_INSTRUCTIONS_MESSAGE,
+    OWNER_INSTRUCTIONS_MESSAGE,
+    ThreadLocalGoogleService,
+    get_google_group_config_from_mailman_config,
+    open_mailman_list,
+    send_email,
+    set_controlled_mailing_list_setting,
+)
+
+handler = colorlog.StreamHandler()
+handler.setFormatter(colorlog.ColoredFormatter("%(log_color)s%(levelname)s:%(message)s"))
+logger = colorlog.getLogger("migration-plan")
+logger.propagate = False
+logger.addHandler(handler)
+
+
+class Plan:
+    """Ordered, deduplicated collection of operations.
+
+    Every operation is a dict with keys "id" (unique and deterministic,
+    so that the same decision made twice results in the same id), "kind",
+    "after" (ids of operations that must complete first), and
+    kind-specific arguments.
+    """
+
+    def __init__(self):
+        self.ops = {}
+
+    def add(self, kind, op_id, after=(), **kwargs):
+        after = [a for a in after if a is not None]
+        if op_id in self.ops:
+            existing = self.ops[op_id]
+            # The same address may be, for example, both a digest and a regular member.
+            # Keep the first operation, but don't lose a manager role.
+            if (
+                kind == "google_member_insert"
+                and kwargs["body"].get("role") == "MANAGER"
+                and existing["body"].get("role", "MEMBER") == "MEMBER"
+            ):
+                existing["body"]["role"] = "MANAGER"
+            logger.debug(f"Dropping duplicate operation {op_id}")
+            return op_id
+        self.ops[op_id] = {"id": op_id, "kind": kind, "after": after, **kwargs}
+        return op_id
+
+    def dump(self, f):
+        for op in self.ops.values():
+            f.write(json.dumps(op) + "\n")
+
+    @classmethod
+    def load(cls, paths):
+        plan = cls()
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        op = json.loads(line)
+                        plan.ops.setdefault(op["id"], op)
+        return plan
+
+
+def plan_google(plan, mmcfg, mm_members, ignore, controlled_mailing_list, add_owner, create_group):
+    ggcfg = get_google_group_config_from_mailman_config(mmcfg)
+    group = ggcfg["email"]
+    ignore = {addr.lower() for addr in ignore}
+    owners = {addr.lower() for addr in mmcfg["owner"]}
+    subscribers = {addr.lower() for addr in mmcfg["digest_members"] + mmcfg["regular_members"]}
+
+    created = None
+    if create_group:
+        if controlled_mailing_list:
+            ggcfg = set_controlled_mailing_list_setting(ggcfg, logger)
+        created = plan.add(
+            "google_group_create",
+            f"google-group-create:{group}",
+            email=group,
+            name=ggcfg["name"],
+            description=ggcfg["description"],
+        )
+        plan.add(
+            "google_group_settings", f"google-group-settings:{group}", [created], email=group, settings=ggcfg
+        )
+        if add_owner:
+            add_owner = add_owner.lower()
+            plan.add(
+                "google_member_insert",
+                f"google-member:{group}:{add_owner}",
+                [created],
+                group=group,
+                body={"email": add_owner, "role": "OWNER", "delivery_settings": "NONE"},
+            )
+
+    def _insert(body):
+        body["email"] = body["email"].lower()
+        if body["email"] in ignore:
+            logger.info(f"Skipping {body['email']} (on the ignore list)")
+            return
+        plan.add(
+            "google_member_insert",
+            f"google-member:{group}:{body['email']}",
+            [created],
+            group=group,
+            body=body,
+        )
+
+    for kind, member in mm_members:
+        body = {"email": member, "delivery_settings": "DIGEST" if kind == "digest_member" else "ALL_MAIL"}
+        if member.lower() in owners:
+            body["role"] = "MANAGER"
+        _insert(body)
+    for owner in sorted(owners - subscribers):
+        _insert({"email": owner, "role": "MANAGER", "delivery_settings": "NONE"})
+    email_regex = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
+    for nonmember in mmcfg["accept_these_nonmembers"]:
+        if not re.match(email_regex, nonmember):
+            logger.warning(f"Ignoring invalid non-member email {nonmember}")
+            continue
+        _insert({"email": nonmember, "delivery_settings": "NONE"})
+
+
+def plan_keycloak(plan, mmcfg, mm_members, keycloak_group, users, required_experiments, extra_admins):
+    usernames = set(users["usernames"])
+    username_from_canon_addr = users["username_from_canon_addr"]
+    admin_group = keycloak_group + "/_admin"
+
+    group_created = plan.add("keycloak_group_create", f"keycloak-group:{keycloak_group}", path=keycloak_group)
+    admin_created = plan.add(
+        "keycloak_group_create", f"keycloak-group:{admin_group}", [group_created], path=admin_group
+    )
+
+    def _add_member(path, username, after):
+        return plan.add(
+            "keycloak_member_add", f"keycloak-member:{path}:{username}", after, path=path, username=username
+        )
+
+    def _add_admin(username):
+        # Adding a user to a group temporarily removes them from its subgroups (see
+        # add_user_group), so the same user must not be added to both concurrently.
+        member_added = f"keycloak-member:{keycloak_group}:{username}"
+        _add_member(
+            admin_group, username, [admin_created, member_added if member_added in plan.ops else None]
+        )
+
+    def _email(kind, to, subject, template):
+        plan.add(
+            "email",
+            f"email:{mmcfg['email']}:{kind}:{to}",
+            [group_created, admin_created],
+            to=to,
+            subject=subject,
+            message=template.format(
+                list_addr=mmcfg["email"], user_addr=to, experiment_list=", ".join(required_experiments)
+            ),
+        )
+
+    email_regex = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
+    allowed_non_members = [nm for nm in mmcfg["accept_these_nonmembers"] if re.match(email_regex, nm)]
+
+    for email in [m for _, m in mm_members] + allowed_non_members:
+        email = email.lower()
+        username, domain = email.split("@")
+        if domain == "icecube.wisc.edu":
+            username = username_from_canon_addr.get(email, username)
+            if username in usernames:
+                _add_member(keycloak_group, username, [group_created])
+                continue
+            logger.warning(f"Unknown user {email}")
+        _email(
+            "member",
+            email,
+            f"Important information about membership in mailing list {mmcfg['email']}",
+            FULL_INSTRUCTIONS_MESSAGE,
+        )
+
+    for username in extra_admins:
+        _add_admin(username)
+
+    for email in mmcfg["owner"]:
+        email = email.lower()
+        username, domain = email.split("@")
+        if domain == "icecube.wisc.edu":
+            username = username_from_canon_addr.get(email, username)
+            if username in usernames:
+                _add_admin(username)
+                continue
+            logger.warning(f"Unknown owner {email}")
+        _email(
+            "owner",
+            email,
+            f"Important information about ownership of mailing list {mmcfg['email']}",
+            OWNER_INSTRUCTIONS_MESSAGE,
+        )
+
+
+class Executor:
+    def __init__(self, plan, journal_path, concurrency, creds, mail_server, email_dryrun, dryrun):
+        self.plan = plan
+        self.journal_path = journal_path
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.mail_server = mail_server
+        self.email_dryrun = email_dryrun
+        self.dryrun = dryrun
+        self.directory = ThreadLocalGoogleService(creds, "admin", "directory_v1") if creds else None
+        self.groupssettings = ThreadLocalGoogleService(creds, "groupssettings", "v1") if creds else None
+        self.keycloak = None
+        self.failed = []
+        self.skipped = []
+
+        self.done = set()
+        if os.path.exists(journal_path):
+            with open(journal_path) as f:
+                self.done = {line.strip() for line in f if line.strip()}
+
+    def _google_group_create(self, op):
+        try:
+            self.directory.get().groups().insert(
+                body={"email": op["email"], "name": op["name"], "description": op["description"]}
+            ).execute()
+        except HttpError as e:
+            if e.status_code != 409:  # entity already exists
+                raise
+
+    def _google_group_settings(self, op):
+        self.groupssettings.get().groups().patch(groupUniqueId=op["email"], body=op["settings"]).execute()
+
+    def _google_member_insert(self, op):
+        members = self.directory.get().members()
+        try:
+            members.insert(groupKey=op["group"], body=op["body"]).execute()
+        except HttpError as e:
+            if e.status_code != 409:  # entity already exists
+                raise
+            # The member may be left over from an earlier attempt, or have been changed by
+            # hand since; either way, make it match the plan.
+            body = {
+                "role": op["body"].get("role", "MEMBER"),
+                "delivery_settings": op["body"]["delivery_settings"],
+            }
+            members.patch(groupKey=op["group"], memberKey=op["body"]["email"], body=body).execute()
+
+    def _email(self, op):
+        send_email(self.mail_server, op["to"], op["subject"], op["message"])
+
+    async def _execute(self, op):
+        kind = op["kind"]
+        if kind == "keycloak_group_create":
+            await create_group(op["path"], rest_client=self.keycloak)
+        elif kind == "keycloak_member_add":
+            await add_user_group(op["path"], op["username"], rest_client=self.keycloak)
+        else:
+            await asyncio.to_thread(getattr(self, f"_{kind}"), op)
+
+    async def _run(self, op, tasks, journal):
+        deps_ok = all(await asyncio.gather(*(tasks[d] for d in op["after"] if d in tasks)))
+        if not deps_ok:
+            logger.warning(f"Skipping {op['id']} (a dependency failed)")
+            self.skipped.append(op["id"])
+            return False
+        async with self.semaphore:
+            logger.info(f"Applying {op['id']}")
+            if self.dryrun:
+                return True
+            if op["kind"] == "email" and self.email_dryrun:
+                # Not journaled, so that the email is sent by a later run without --email-dry-run
+                logger.info(f"Not sending email to {op['to']} (email dry run)")
+                return True
+            try:
+                await self._execute(op)
+            except Exception as e:
+                logger.error(f"Failed {op['id']}: {e}")
+                self.failed.append(op["id"])
+                return False
+        journal.write(op["id"] + "\n")
+        journal.flush()
+        return True
+
+    async def apply(self):
+        ops = [op for op in self.plan.ops.values() if op["id"] not in self.done]
+        logger.info(f"{len(ops)} operation(s) to apply, {len(self.plan.ops) - len(ops)} already done")
+        for op in ops:
+            for dep in op["after"]:
+                if dep not in self.plan.ops:
+                    raise ValueError(f"Operation {op['id']} depends on {dep}, which is not in the plan")
+        if any(op["kind"].startswith("keycloak_") for op in ops) and not self.dryrun:
+            self.keycloak = get_rest_client()
+
+        with open(self.journal_path, "a") as journal:
+            tasks = {}
+            # None of the tasks start running before all of them are created,
+            # so every task can find the tasks it depends on.
+            for op in ops:
+                tasks[op["id"]] = asyncio.ensure_future(self._run(op, tasks, journal))
+            await asyncio.gather(*tasks.values())
+
+        if self.directory:
+            self.directory.close()
+            self.groupssettings.close()
+
+
+async def cache_keycloak_users(path):
+    logger.info("Retrieving info of all users from KeyCloak")
+    all_users = await list_users(rest_client=get_rest_client())
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "usernames": sorted(all_users),
+                "username_from_canon_addr": {
+                    u["attributes"]["canonical_email"]: u["username"]
+                    for u in all_users.values()
+                    if "canonical_email" in u["attributes"]
+                },
+            },
+            f,
+        )
+    logger.info(f"Saved {len(all_users)} users to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--log-level",
+        default="info",
+        choices=("debug", "info", "warning", "error"),
+        help="logging level (default: info)",
+    )
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    parser_cache = subparsers.add_parser(
+        "cache-keycloak-users", help="save KeyCloak user info needed by `plan`"
+    )
+    parser_cache.add_argument("--output", metavar="PATH", required=True, help="output JSON file")
+
+    parser_plan = subparsers.add_parser("plan", help="create a migration plan for a mailman list")
+    parser_plan.add_argument(
+        "--mailman-pickle",
+        metavar="PATH",
+        required=True,
+        help="mailman list configuration pickle created by pickle-mailman-list.py, or - for stdin stream",
+    )
+    parser_plan.add_argument("--output", metavar="PATH", default="-", help="plan file (default: stdout)")
+    parser_plan.add_argument("--google", action="store_true", help="plan Google group members")
+    parser_plan.add_argument(
+        "--google-create-group", action="store_true", help="also plan Google group creation and settings"
+    )
+    parser_plan.add_argument(
+        "--controlled-mailing-list",
+        action="store_true",
+        help="override Google group settings to be compatible with the controlled mailing list paradigm",
+    )
+    parser_plan.add_argument(
+        "--add-owner", metavar="EMAIL", help="make EMAIL Google group owner that doesn't receive email"
+    )
+    parser_plan.add_argument(
+        "--ignore", metavar="EMAIL", default=[], nargs="*", help="don't add EMAIL to Google group members"
+    )
+    parser_plan.add_argument(
+        "--keycloak-group", metavar="PATH", help="plan population of this KeyCloak group"
+    )
+    parser_plan.add_argument(
+        "--keycloak-users", metavar="PATH", help="KeyCloak user info saved by `cache-keycloak-users`"
+    )
+    parser_plan.add_argument(
+        "--required-experiments", metavar="NAME", nargs="+", default=[], help="experiment(s) to use in emails"
+    )
+    parser_plan.add_argument(
+        "--extra-admins", metavar="USER", nargs="+", default=[], help="add USER(s) to the _admin subgroup"
+    )
+
+    parser_apply = subparsers.add_parser("apply", help="apply migration plan(s)")
+    parser_apply.add_argument("plans", metavar="PLAN", nargs="+", help="plan file(s) created by `plan`")
+    parser_apply.add_argument(
+        "--journal", metavar="PATH", required=True, help="file that records completed operations"
+    )
+    parser_apply.add_argument(
+        "--concurrency", metavar="NUM", type=int, default=8, help="maximum concurrent operations (default: 8)"
+    )
+    parser_apply.add_argument("--sa-creds", metavar="PATH", help="service account credentials JSON")
+    parser_apply.add_argument(
+        "--sa-delegate", metavar="EMAIL", help="the principal whom the service account will impersonate"
+    )
+    parser_apply.add_argument("--mail-server", metavar="HOST", help="use HOST to send instructional emails")
+    parser_apply.add_argument(
+        "--dry-run", action="store_true", help="log operations that would be applied without applying them"
+    )
+    parser_apply.add_argument(
+        "--email-dry-run", action="store_true", help="apply everything except emails, which are only logged"
+    )
+
+    args = parser.parse_args()
+
+    logger.setLevel(getattr(logging, args.log_level.upper()))
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    if args.log_level == "info":
+        ClientCredentialsAuth = logging.getLogger("ClientCredentialsAuth")
+        ClientCredentialsAuth.setLevel(logging.WARNING)  # too noisy
+
+    if args.action == "cache-keycloak-users":
+        asyncio.run(cache_keycloak_users(args.output))
+
+    elif args.action == "plan":
+        if not args.google and not args.keycloak_group:
+            parser.error("nothing to plan: use --google and/or --keycloak-group")
+        if args.keycloak_group and not (args.keycloak_users and args.required_experiments):
+            parser.error("--keycloak-group requires --keycloak-users and --required-experiments")
+        mmcfg, mm_members = open_mailman_list(args.mailman_pickle)
+        mm_members = list(mm_members)
+        plan = Plan()
+        if args.google:
+            plan_google(
+                plan,
+                mmcfg,
+                mm_members,
+                args.ignore,
+                args.controlled_mailing_list,
+                args.add_owner,
+                args.google_create_group,
+            )
+        if args.keycloak_group:
+            with open(args.keycloak_users) as f:
+                users = json.load(f)
+            plan_keycloak(
+                plan,
+                mmcfg,
+                mm_members,
+                args.keycloak_group,
+                users,
+                args.required_experiments,
+                args.extra_admins,
+            )
+        logger.info(f"Planned {len(plan.ops)} operation(s)")
+        if args.output == "-":
+            plan.dump(sys.stdout)
+        else:
+            with open(args.output, "w") as f:
+                plan.dump(f)
+
+    elif args.action == "apply":
+        plan = Plan.load(args.plans)
+        kinds = {op["kind"] for op in plan.ops.values()}
+        creds = None
+        if (
+            kinds & {"google_group_create", "google_group_settings", "google_member_insert"}
+            and not args.dry_run
+        ):
+            if not (args.sa_creds and args.sa_delegate):
+                parser.error("plan has Google operations: --sa-creds and --sa-delegate are required")
+            scopes = [
+                "https://www.googleapis.com/auth/admin.directory.group",
+                "https://www.googleapis.com/auth/admin.directory.group.member",
+                "https://www.googleapis.com/auth/apps.groups.settings",
+            ]
+            creds = service_account.Credentials.from_service_account_file(
+                args.sa_creds, scopes=scopes, subject=args.sa_delegate
+            )
+        if "email" in kinds and not args.mail_server and not (args.dry_run or args.email_dry_run):
+            parser.error("plan has email operations: --mail-server is required")
+
+        executor = Executor(
+            plan, args.journal, args.concurrency, creds, args.mail_server, args.email_dry_run, args.dry_run
+        )
+        asyncio.run(executor.apply())
+        if executor.failed or executor.skipped:
+            logger.error(
+                f"{len(executor.failed)} operation(s) failed and {len(executor.skipped)} were skipped; "
+                f"fix the problem and apply again to retry them"
+            )
+            return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
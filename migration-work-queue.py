@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""
+Distribute mailman list migration across several hosts using a work queue
+kept in an SQLite file on a shared filesystem.
+
+Lists (pickle files created by `pickle-mailman-list.py`) are added to the
+queue with `enqueue`. Any number of `work` processes, on any number of hosts,
+then repeatedly claim a list, run an importer command for it, and mark it
+done. A claim is a lease that the worker renews (heartbeats) while the
+command is running. If the command fails, the list is released for another
+attempt; if the worker dies, the lease expires and the list is picked up
+by another worker. Workers don't exit while lists are leased by others, so
+that such lists are picked up even at the end of the run.
+
+A list that fails, or whose lease expires, --max-attempts times is marked
+failed. Retrying means running the command again from the start, so use
+--max-attempts 1 for commands that are not safe to repeat. For example,
+mailman-to-keycloak-member-import.py re-sends notification emails to
+everyone on the list when it is re-run (unless --email-dry-run is given).
+
+Example:
+    migration-work-queue.py --queue /shared/q.sqlite enqueue /shared/pkl/*.pkl
+    migration-work-queue.py --queue /shared/q.sqlite work -- \\
+        ./mailman-to-google-group-members-import.py --mailman-pickle {pickle} ...
+    migration-work-queue.py --queue /shared/q.sqlite work --max-attempts 1 -- \\
+        ./mailman-to-keycloak-member-import.py --mailman-pickle {pickle} ...
+"""
+
+import argparse
+import colorlog
+import contextlib
+import logging
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+handler = colorlog.StreamHandler()
+handler.setFormatter(colorlog.ColoredFormatter("%(log_color)s%(levelname)s:%(message)s"))
+logger = colorlog.getLogger("work-queue")
+logger.propagate = False
+logger.addHandler(handler)
+
+
+class WorkQueue:
+    """Lease-based queue of pickle files stored in an SQLite database."""
+
+    def __init__(self, path):
+        # Writers wait for each other rather than fail; claims are short transactions.
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS lists ("
+            "  pickle TEXT PRIMARY KEY,"
+            "  state TEXT NOT NULL DEFAULT 'pending',"  # pending, leased, done, failed
+            "  worker TEXT,"
+            "  lease_expires REAL,"
+            "  attempts INTEGER NOT NULL DEFAULT 0,"
+            "  last_error TEXT)"
+        )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock up front, so that two workers
+        # can't both read the same list as available and then claim it.
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def enqueue(self, pickles):
+        with self.transaction():
+            cur = self.db.executemany(
+                "INSERT OR IGNORE INTO lists (pickle) VALUES (?)", ((p,) for p in pickles)
+            )
+        return cur.rowcount
+
+    def claim(self, worker, lease_seconds, max_attempts):
+        """Lease the next available list to `worker` and return its pickle path, or None.
+
+        Expired leases of lists that have used up `max_attempts` are not
+        taken over; those lists are marked failed instead.
+        """
+        now = time.time()
+        with self.transaction():
+            self.db.execute(
+                "UPDATE lists SET state = 'failed', lease_expires = NULL, last_error = 'lease expired'"
+                " WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, max_attempts),
+            )
+            row = self.db.execute(
+                "SELECT pickle FROM lists"
+                " WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)"
+                " ORDER BY attempts, pickle LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                self.db.execute(
+                    "UPDATE lists SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1"
+                    " WHERE pickle = ?",
+                    (worker, now + lease_seconds, row[0]),
+                )
+        return row[0] if row else None
+
+    def heartbeat(self, pickle, worker, lease_seconds):
+        """Extend the lease. Return False if `worker` no longer holds it."""
+        with self.transaction():
+            cur = self.db.execute(
+                "UPDATE lists SET lease_expires = ? WHERE pickle = ? AND worker = ? AND state = 'leased'",
+                (time.time() + lease_seconds, pickle, worker),
+            )
+        return cur.rowcount == 1
+
+    def complete(self, pickle, worker):
+        with self.transaction():
+            self.db.execute(
+                "UPDATE lists SET state = 'done', lease_expires = NULL, last_error = NULL"
+                " WHERE pickle = ? AND worker = ?",
+                (pickle, worker),
+            )
+
+    def release(self, pickle, worker, error, max_attempts):
+        """Give up the lease after a failure. The list is retried unless it ran out of attempts."""
+        with self.transaction():
+            self.db.execute(
+                "UPDATE lists SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+                " lease_expires = NULL, last_error = ? WHERE pickle = ? AND worker = ?",
+                (max_attempts, error, pickle, worker),
+            )
+
+    def reset_failed(self):
+        with self.transaction():
+            cur = self.db.execute("UPDATE lists SET state = 'pending', attempts = 0 WHERE state = 'failed'")
+        return cur.rowcount
+
+    def num_leased(self):
+        return self.db.execute("SELECT COUNT(*) FROM lists WHERE state = 'leased'").fetchone()[0]
+
+    def status(self):
+        return self.db.execute(
+            "SELECT pickle, state, worker, attempts, last_error FROM lists ORDER BY state, pickle"
+        ).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def run_leased(queue, pickle, worker, command, lease_seconds, heartbeat_interval):
+    """Run `command` for `pickle` while renewing the lease.
+
+    Returns:
+        str|None: None on success, otherwise a description of the failure
+    """
+    argv = [arg.replace("{pickle}", pickle) for arg in command]
+    logger.info(f"Running {' '.join(argv)}")
+    proc = subprocess.Popen(argv)
+    try:
+        while True:
+            try:
+                returncode = proc.wait(timeout=heartbeat_interval)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if not queue.heartbeat(pickle, worker, lease_seconds):
+                logger.error(f"Lost lease on {pickle}; terminating the command")
+                return "lease lost"
+    finally:
+        # Also if renewing the lease failed, e.g. because the queue stayed locked:
+        # the command must not keep running without a lease.
+        if proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+    if returncode:
+        return f"command exited with status {returncode}"
+    return None
+
+
+def work(args, queue):
+    worker = args.worker_id
+    while True:
+        pickle = queue.claim(worker, args.lease_seconds, args.max_attempts)
+        if pickle is None:
+            if not queue.num_leased():
+                logger.info("Nothing left to claim")
+                return
+            # Another worker may die, and its lists would then have nobody to take them over
+            logger.debug("Waiting for lists leased by other workers")
+            time.sleep(args.heartbeat_interval)
+            continue
+        logger.info(f"Claimed {pickle}")
+        try:
+            error = run_leased(
+                queue, pickle, worker, args.command, args.lease_seconds, args.heartbeat_interval
+            )
+        except BaseException as e:
+            queue.release(pickle, worker, f"{type(e).__name__}: {e}", args.max_attempts)
+            raise
+        if error is None:
+            queue.complete(pickle, worker)
+            logger.info(f"Completed {pickle}")
+        else:
+            queue.release(pickle, worker, error, args.max_attempts)
+            logger.error(f"Failed {pickle}: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--queue",
+        metavar="PATH",
+        required=True,
+        help="SQLite work queue file (on a filesystem shared by all workers)",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="info",
+        choices=("debug", "info", "warning", "error"),
+        help="logging level (default: info)",
+    )
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    parser_enqueue = subparsers.add_parser("enqueue", help="add lists to the queue")
+    parser_enqueue.add_argument("pickles", metavar="PICKLE", nargs="+", help="mailman list pickle file")
+
+    parser_work = subparsers.add_parser(
+        "work", help="claim and process lists until all lists are done or failed"
+    )
+    parser_work.add_argument(
+        "--worker-id",
+        metavar="ID",
+        default=f"{socket.gethostname()}:{os.getpid()}",
+        help="identity of this worker (default: HOST:PID)",
+    )
+    parser_work.add_argument(
+        "--lease-seconds",
+        metavar="SECONDS",
+        type=float,
+        default=300,
+        help="a claim not renewed for this long can be taken over by another worker (default: 300)",
+    )
+    parser_work.add_argument(
+        "--heartbeat-interval",
+        metavar="SECONDS",
+        type=float,
+        default=60,
+        help="how often to renew the lease while the command is running (default: 60)",
+    )
+    parser_work.add_argument(
+        "--max-attempts",
+        metavar="NUM",
+        type=int,
+        default=3,
+        help="mark a list as failed after this many unsuccessful attempts (default: 3); "
+        "use 1 for commands that send email, such as the KeyCloak importer",
+    )
+    parser_work.add_argument(
+        "command",
+        metavar="COMMAND",
+        nargs=argparse.REMAINDER,
+        help="importer command to run; {pickle} is replaced with the claimed pickle path",
+    )
+
+    subparsers.add_parser("status", help="show the state of all lists")
+    subparsers.add_parser("reset-failed", help="make failed lists available again")
+
+    args = parser.parse_args()
+
+    logger.setLevel(getattr(logging, args.log_level.upper()))
+
+    queue = WorkQueue(args.queue)
+    try:
+        if args.action == "enqueue":
+            logger.info(f"Added {queue.enqueue(args.pickles)} list(s) to the queue")
+        elif args.action == "work":
+            if args.command and args.command[0] == "--":
+                args.command = args.command[1:]
+            if not args.command:
+                parser.error("work requires a command")
+            if args.heartbeat_interval >= args.lease_seconds:
+                parser.error("--heartbeat-interval must be shorter than --lease-seconds")
+            work(args, queue)
+        elif args.action == "status":
+            for pickle, state, worker, attempts, last_error in queue.status():
+                print(
+                    f"{state:8} {pickle} attempts={attempts} worker={worker or '-'}"
+                    + (f" error={last_error}" if last_error else "")
+                )
+        elif args.action == "reset-failed":
+            logger.info(f"Reset {queue.reset_failed()} failed list(s)")
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,14 @@
 """
 Save in a python pickle file settings and members of a mailman mailing list.
 
+With --stream, write instead to stdout a stream of pickled (kind, value)
+records: one "config" record (settings without members), then one
+"digest_member" or "regular_member" record per member, written as soon as
+mailman reports it, and finally an "end" record. This allows piping the
+output directly into the importers (e.g. `ssh mailman pickle-mailman-list.py
+--stream --list EMAIL | mailman-to-google-group-members-import.py
+--mailman-pickle - ...`).
+
 This needs to work with python2.7.
 """
 import argparse
@@ -16,6 +24,23 @@ def popen_stdout(args):
     return stdout
 
 
+def popen_lines(args):
+    p = subprocess.Popen(args, stdout=subprocess.PIPE)
+    for l in iter(p.stdout.readline, b""):
+        if l.strip():
+            yield l.strip().decode("ascii")
+    # Failing here, before the "end" record is written, lets readers of the
+    # stream tell a truncated member list from a complete one.
+    if p.wait() != 0:
+        raise subprocess.CalledProcessError(p.returncode, args)
+
+
+def write_record(out, kind, value):
+    # protocol 2 is the highest protocol python2.7 supports
+    pickle.dump((kind, value), out, 2)
+    out.flush()
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Save in EMAIL.pkl (python pickle) the settings and members of a "
@@ -29,6 +54,11 @@ def main():
         default="/usr/lib/mailman/bin/",
         help="mailman bin directory",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="write a stream of records to stdout instead of EMAIL.pkl",
+    )
     args = parser.parse_args()
 
     if "@" not in args.list:
@@ -40,6 +70,16 @@ def main():
     stdout = popen_stdout([args.bin_dir + "/config_list", "-o", "-", listname])
     exec(stdout, None, cfg)
 
+    if args.stream:
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+        write_record(out, "config", cfg)
+        for member in popen_lines([args.bin_dir + "/list_members", "--digest", listname]):
+            write_record(out, "digest_member", member)
+        for member in popen_lines([args.bin_dir + "/list_members", "--regular", listname]):
+            write_record(out, "regular_member", member)
+        write_record(out, "end", None)
+        return
+
     stdout = popen_stdout([args.bin_dir + "/list_members", "--digest", listname])
     cfg["digest_members"] = [
         l.strip().decode("ascii") for l in stdout.split("\n") if l.strip()
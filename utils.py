@@ -1,3 +1,108 @@
+import collections
+import google_auth_httplib2
+import httplib2
+import json
+import logging
+import logging.handlers
+import pickle
+import queue
+import smtplib
+import sys
+import threading
+import time
+
+from email.message import EmailMessage
+from googleapiclient import discovery
+
+FULL_INSTRUCTIONS_MESSAGE = """
+You are receiving this messages because you need to take action to
+ensure uninterrupted delivery of messages from mailing list {list_addr}.
+
+Please ignore this email if it is a duplicate and you have already
+taken the required actions.
+
+In the near future this mailing list will become restricted to
+active members of {experiment_list} experiment(s),
+and require subscribers to either use their IceCube email address
+or configure a custom email address in their profile to be used
+for all mailing lists whose membership management is automated.
+
+You are currently subscribed to {list_addr} using
+{user_addr}, which is either a non-IceCube, or a disallowed email
+address, or you are not a member of an institution belonging to
+{experiment_list} experiment(s).
+
+In order to remain subscribed to {list_addr} after enforcement
+of membership restrictions begins you must:
+
+(1) If you prefer to use a non-IceCube email for ALL automatically-
+    managed mailing lists, you must configure it in your user profile.
+    (Skip this step if you want to use your IceCube address.)
+    - Go to https://user-management.icecube.aq and log in using
+      your IceCube credentials.
+    - Under "My profile", fill in "mailing_list_email" field and
+      click "Update".
+
+(2) Ensure that you are a member of an institution belonging to
+    one of {experiment_list} experiment(s).
+    - Go to https://user-management.icecube.aq and log in using
+      your IceCube credentials.
+    - Check your experiments under "Experiments/Institutions".
+    - If necessary, click "Join an institution", select an experiment
+      and an institution, and click "Submit Join Request".
+      Wait until your request is approved before proceeding
+      to step 3.
+
+(3) Join the mailing list group corresponding to this list.
+    - Go to https://user-management.icecube.aq and log in using
+      your IceCube credentials.
+    - Under "Groups" at the bottom of the page, click "Join a group"
+    - Select the appropriate group (look for prefix "/mail/")
+    - Click "Submit Join Request"
+
+In order to avoid a disruption in receiving of messages from
+{list_addr} once it becomes restricted,
+you must complete the steps above, and your requests
+must be approved prior to the transition.
+
+Taking the steps above will not affect your current subscription,
+so we recommend completing them soon, since it may take some time
+for requests to get approved.
+
+If you have questions or need help, please email help@icecube.wisc.edu.
+"""
+
+OWNER_INSTRUCTIONS_MESSAGE = """
+You are receiving this message because you are registered as an owner of
+{list_addr} using {user_addr}, which is either
+a non-IceCube or a disallowed email address.
+
+In the near future this mailing list will become restricted to
+active members of {experiment_list} experiment(s),
+and only allow either IceCube email addresses or addresses registered
+in the user profile attribute "mailing_list_email". This will apply
+to owners as well.
+ 
+In order to remain an owner of {list_addr}
+after the transition, you must send a request to help@icecube.wisc.edu.
+For example:
+
+Please make <YOUR_ICECUBE_USERNAME> an administrator of the
+controlled mailing list {list_addr}.
+
+Once your reqeust is acted upon and you are added to the mailing list
+as an owner, if you would rather not receive {list_addr}
+traffic, or if you later set "mailing_list_email" attribute on
+https://user-management.icecube.aq and find yourself receiving duplicate
+emails, you can selectively stop mail delivery by going to
+https://groups.google.com, logging on with your IceCube account and
+changing "Subscription" value associated with {list_addr}
+from "Each email" to "No Email".
+
+If you have questions or need help, please email help@icecube.wisc.edu.
+"""
+
+
 def get_google_group_config_from_mailman_config(mmcfg):
     # https://developers.google.com/admin-sdk/groups-settings/v1/reference/groups#json
     if mmcfg["advertised"] and mmcfg["archive"]:
@@ -72,3 +177,219 @@ def get_google_group_config_from_mailman_config(mmcfg):
         "defaultSender": "DEFAULT_SELF",
     }
     return ggcfg
+
+
+def set_controlled_mailing_list_setting(ggcfg, logger=logging):
+    def _override(cfg, key, value):
+        if key not in cfg:
+            logger.warning(f"Setting {key} to be '{value}'")
+        elif cfg[key] != value:
+            logger.warning(f"Overriding {key} from '{cfg[key]}' to '{value}'")
+        cfg[key] = value
+
+    _override(ggcfg, "whoCanJoin", "INVITED_CAN_JOIN")
+    _override(ggcfg, "whoCanViewGroup", "ALL_MEMBERS_CAN_VIEW")
+    _override(ggcfg, "whoCanLeaveGroup", "NONE_CAN_LEAVE")
+    _override(ggcfg, "includeCustomFooter", "true")
+    _override(
+        ggcfg,
+        "customFooterText",
+        "Message archives are on https://groups.google.com (log in with your IceCube account)\n"
+        "To unsubscribe, use group membership management interface of https://user-management.icecube.aq",
+    )
+    _override(ggcfg, "whoCanModerateMembers", "NONE")
+
+    return ggcfg
+
+
+def send_email(smtp_host, to, subj, message):
+    msg = EmailMessage()
+    msg["Subject"] = subj
+    msg["From"] = "no-reply@icecube.wisc.edu"
+    msg["To"] = to
+    msg.set_content(message)
+    with smtplib.SMTP(smtp_host) as s:
+        s.send_message(msg)
+
+
+class ThreadLocalGoogleService:
+    """Google API service objects, one per thread.
+
+    googleapiclient service objects and their httplib2 transports are not
+    thread-safe, so every thread gets its own authorized HTTP client and
+    service object built from the shared credentials.
+    """
+
+    def __init__(self, creds, service_name, version):
+        self.creds = creds
+        self.service_name = service_name
+        self.version = version
+        self.local = threading.local()
+        self.services = []
+        self.services_lock = threading.Lock()
+
+    def get(self):
+        if not hasattr(self.local, "svc"):
+            http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+            self.local.svc = discovery.build(
+                self.service_name, self.version, http=http, cache_discovery=False
+            )
+            with self.services_lock:
+                self.services.append(self.local.svc)
+        return self.local.svc
+
+    def close(self):
+        with self.services_lock:
+            for svc in self.services:
+                svc.close()
+            self.services.clear()
+
+
+# Record kinds of the framed stream written by `pickle-mailman-list.py --stream`.
+# The stream is a sequence of pickled (kind, value) tuples: one "config" record
+# (list settings without members), followed by any number of "digest_member"
+# and "regular_member" records, terminated by an "end" record.
+STREAM_MEMBER_KINDS = {"digest_member": "digest_members", "regular_member": "regular_members"}
+
+
+def iter_mailman_stream(f):
+    """Yield (kind, value) records from the framed stream in binary file `f`."""
+    while True:
+        try:
+            kind, value = pickle.load(f, encoding="latin1")
+        except EOFError:
+            raise RuntimeError("Mailman list stream ended without an end record")
+        if kind == "end":
+            return
+        yield kind, value
+
+
+def open_mailman_list(path):
+    """Start reading a mailman list created by `pickle-mailman-list.py`.
+
+    `path` is either a pickle file, or "-" for a framed stream on stdin.
+
+    Returns (mmcfg, members), where `members` is an iterator of
+    (kind, email) tuples, with kind being "digest_member" or "regular_member".
+    Digest and regular member lists of `mmcfg` are filled in as `members`
+    is consumed, so `mmcfg` is complete once the iterator is exhausted.
+    When reading a stream, members are yielded as soon as they arrive.
+    """
+    if path == "-":
+        records = iter_mailman_stream(sys.stdin.buffer)
+        kind, mmcfg = next(records)
+        if kind != "config":
+            raise RuntimeError(f"Mailman list stream starts with {kind} instead of config")
+    else:
+        with open(path, "rb") as f:
+            mmcfg = pickle.load(f)
+        records = [(kind, email) for kind, key in STREAM_MEMBER_KINDS.items() for email in mmcfg[key]]
+
+    for key in STREAM_MEMBER_KINDS.values():
+        mmcfg[key] = []
+
+    def _members():
+        for kind, email in records:
+            if kind not in STREAM_MEMBER_KINDS:
+                raise RuntimeError(f"Unexpected record {kind} in mailman list stream")
+            mmcfg[STREAM_MEMBER_KINDS[kind]].append(email)
+            yield kind, email
+
+    return mmcfg, _members()
+
+
+def load_mailman_list(path):
+    """Return complete mailman list configuration from a pickle file or "-" (stdin stream)."""
+    mmcfg, members = open_mailman_list(path)
+    for _ in members:
+        pass
+    return mmcfg
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format records as JSON objects, one per line, including the member event, if any."""
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "member_event", None):
+            entry["member_event"] = record.member_event
+        return json.dumps(entry)
+
+
+class MemberProgressHandler(logging.Handler):
+    """Forward records to `target`, except that per-member records below WARNING
+    (those logged with `extra={"member_event": EVENT}`) are only counted.
+    Counts are forwarded every `interval` seconds, and once more on close.
+    """
+
+    def __init__(self, target, interval):
+        super().__init__()
+        self.target = target
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.last_report = time.monotonic()
+
+    def emit(self, record):
+        event = getattr(record, "member_event", None)
+        if event is None or record.levelno >= logging.WARNING:
+            self.target.handle(record)
+            return
+        self.counts[event] += 1
+        self.logger_name = record.name
+        if time.monotonic() - self.last_report >= self.interval:
+            self._report("Progress")
+
+    def _report(self, title):
+        self.last_report = time.monotonic()
+        counts = ", ".join(f"{event}: {count}" for event, count in sorted(self.counts.items()))
+        self.target.handle(
+            logging.makeLogRecord(
+                {
+                    "name": self.logger_name,
+                    "levelno": logging.INFO,
+                    "levelname": "INFO",
+                    "msg": f"{title}: {counts}",
+                }
+            )
+        )
+
+    def close(self):
+        if self.counts:
+            self._report("Summary")
+            self.counts.clear()
+        super().close()
+
+
+def start_logging(logger, console_handler, json_path=None, progress_interval=None):
+    """Make `logger` write through a queue, so that logging doesn't block the caller.
+
+    Records are written to `console_handler` and, if `json_path` is given, as
+    JSON lines to that file. If `progress_interval` is given, per-member records
+    (see MemberProgressHandler) are replaced on the console by periodic counts.
+
+    Returns:
+        QueueListener: pass to stop_logging() to flush the queue
+    """
+    handlers = [console_handler]
+    if progress_interval is not None:
+        handlers[0] = MemberProgressHandler(console_handler, progress_interval)
+    if json_path:
+        json_handler = logging.FileHandler(json_path)
+        json_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(json_handler)
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def stop_logging(listener):
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()